@@ -0,0 +1,63 @@
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from telegram import InputMediaPhoto, InputMediaVideo
+
+# Ограничения Telegram
+MAX_ALBUM_SIZE = 10
+MAX_CAPTION_LENGTH = 1024
+
+
+class PostPart(NamedTuple):
+    """Часть поста, отправляемая одним запросом.
+
+    Текстовая часть не содержит медиафайлов; медиачасть содержит
+    от одного до ``MAX_ALBUM_SIZE`` пар (тип, источник) и подпись
+    к первому файлу.
+    """
+    text: Optional[str] = None
+    media: tuple = ()
+
+
+def post_text(post):
+    """Текст поста"""
+    return f"{post['title']}\n\n{post['text']}"
+
+
+def compile_post(post, text=None):
+    """Разбиение поста на минимальное число отправок.
+
+    Изображения и видео собираются в альбомы по ``MAX_ALBUM_SIZE``
+    файлов. Текст становится подписью к первому файлу, если помещается
+    в подпись, иначе отправляется отдельным сообщением. Уже отрисованный
+    текст поста можно передать в ``text``.
+    """
+    if text is None:
+        text = post_text(post)
+    media = ([('photo', url) for url in post.get('image') or ()]
+             + [('video', url) for url in post.get('video') or ()])
+    if not media:
+        return [PostPart(text=text)]
+
+    parts = []
+    caption = text
+    if len(text) > MAX_CAPTION_LENGTH:
+        parts.append(PostPart(text=text))
+        caption = None
+    for start in range(0, len(media), MAX_ALBUM_SIZE):
+        parts.append(PostPart(caption,
+                              tuple(media[start:start + MAX_ALBUM_SIZE])))
+        caption = None
+    return parts
+
+
+def input_media(kind, media, caption=None):
+    """Элемент альбома для send_media_group"""
+    if isinstance(media, Path):
+        # Вне локального Bot API альбом не принимает пути к файлам,
+        # поэтому содержимое файла читается сразу
+        with media.open('rb') as media_file:
+            return input_media(kind, media_file, caption)
+    if kind == 'video':
+        return InputMediaVideo(media, caption=caption)
+    return InputMediaPhoto(media, caption=caption)
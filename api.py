@@ -1,102 +1,415 @@
+import asyncio
 import aiohttp
 import logging
-from config import API_URL_POST, API_URL_USER, HEADERS
+from functools import partial
+from typing import NamedTuple, Optional
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+from config import (
+    API_URL_POST, API_URL_USER, API_URL_USER_BULK, HEADERS, API_POOL_SIZE,
+    API_POOL_PER_HOST,
+    API_KEEPALIVE_TIMEOUT, API_DNS_CACHE_TTL, API_PAGE_SIZE, API_PAGE_PARAM,
+    API_PAGE_SIZE_PARAM, API_PREFETCH_PAGES, API_POST_SINCE_PARAM,
+    API_POST_ORDER_PARAM, API_TIMEOUT, API_RETRIES, API_RETRY_BASE_DELAY,
+    API_RETRY_MAX_DELAY, API_BREAKER_THRESHOLD, API_BREAKER_RESET,
+    API_HEDGE_DELAY, API_FIELDS_PARAM
 )
+from metrics import client_trace
+from resilience import CircuitBreaker, CircuitOpenError, hedged, retry
+
 logger = logging.getLogger(__name__)
 
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ApiError(Exception):
+    """Ошибка обращения к JetAdmin API"""
+
+
+class TransientApiError(ApiError):
+    """Временная ошибка API: сбой сети, тайм-аут или перегрузка сервера"""
+
+
+# Исключения, после которых запрос повторяется
+TRANSIENT_ERRORS = (TransientApiError, aiohttp.ClientError,
+                    asyncio.TimeoutError)
+
+
+def api_table(url):
+    """Имя таблицы JetAdmin для метрик запроса"""
+    if API_URL_USER_BULK and url.startswith(API_URL_USER_BULK):
+        return 'users_bulk'
+    if url.startswith(API_URL_POST):
+        return 'posts'
+    if url.startswith(API_URL_USER):
+        return 'users'
+    return 'other'
+
+
+class ApiClient:
+    """Долгоживущий клиент JetAdmin API с общим пулом соединений"""
+
+    def __init__(self, pool_size=API_POOL_SIZE,
+                 pool_per_host=API_POOL_PER_HOST,
+                 keepalive_timeout=API_KEEPALIVE_TIMEOUT,
+                 dns_cache_ttl=API_DNS_CACHE_TTL, timeout=API_TIMEOUT):
+        self.pool_size = pool_size
+        self.pool_per_host = pool_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self.breaker = CircuitBreaker('JetAdmin API', API_BREAKER_THRESHOLD,
+                                      API_BREAKER_RESET)
+        self._session = None
+
+    @property
+    def session(self):
+        """Общая сессия; открывается при первом обращении"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, headers=HEADERS,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[client_trace(api_table)]
+            )
+            logger.info('Открыта сессия JetAdmin API: пул %s, на хост %s',
+                        self.pool_size, self.pool_per_host)
+        return self._session
+
+    async def start(self):
+        """Открытие сессии при запуске приложения"""
+        return self.session
+
+    async def close(self):
+        """Закрытие сессии и пула соединений"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info('Сессия JetAdmin API закрыта')
+        self._session = None
+
+    async def call(self, factory, idempotent=False, hedge=False):
+        """Вызов API через автомат защиты.
+
+        Идемпотентные запросы повторяются с экспоненциальной паузой,
+        ``hedge`` дублирует медленный запрос. Временные сбои
+        превращаются в ``TransientApiError``.
+        """
+        try:
+            trial = self.breaker.check()
+        except CircuitOpenError as error:
+            raise TransientApiError(str(error)) from error
+        attempt = factory
+        if hedge:
+            attempt = partial(hedged, factory, API_HEDGE_DELAY)
+        try:
+            if idempotent:
+                result = await retry(attempt, API_RETRIES,
+                                     API_RETRY_BASE_DELAY,
+                                     API_RETRY_MAX_DELAY, TRANSIENT_ERRORS)
+            else:
+                result = await attempt()
+        except TRANSIENT_ERRORS as error:
+            self.breaker.record_failure()
+            if isinstance(error, TransientApiError):
+                raise
+            raise TransientApiError(
+                f'Ошибка сети: {error!r}'
+            ) from error
+        except ApiError:
+            # Сервис ответил, хоть и ошибкой: он доступен
+            self.breaker.record_success()
+            raise
+        finally:
+            # Пробный вызов, прерванный отменой, не блокирует автомат
+            if trial:
+                self.breaker.release()
+        self.breaker.record_success()
+        return result
+
+
+api_client = ApiClient()
+
+
+async def check_status(response, label, expected=(200,)):
+    """Проверка статуса ответа API"""
+    if response.status in expected:
+        return
+    text = await response.text()
+    message = f'Ошибка {label}: {response.status}, ответ: {text[:200]}'
+    if response.status in RETRY_STATUSES:
+        raise TransientApiError(message)
+    raise ApiError(message)
+
+
+async def read_json(response, label):
+    """Разбор JSON-ответа API"""
+    try:
+        return await response.json(content_type=None)
+    except ValueError as error:
+        raise ApiError(f'Ошибка чтения ответа API {label}: {error}') from error
+
+
+class Page(NamedTuple):
+    """Страница ответа API"""
+    results: list
+    next_url: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    not_modified: bool = False
+    # Ответ содержит ключ next: его пустое значение означает,
+    # что страница последняя
+    linked: bool = False
+
+
+async def fetch_page(url, params=None, label='записей', headers=None):
+    """Запрос одной страницы таблицы.
+
+    Возвращает ``Page``; при ошибке вызывает ``ApiError``. При условном
+    запросе (``headers`` с If-None-Match/If-Modified-Since) ответ 304
+    возвращается как пустая страница с признаком ``not_modified``.
+    """
+    async def request():
+        async with api_client.session.get(url, params=params,
+                                          headers=headers) as response:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if response.status == 304:
+                return Page([], None, etag, last_modified, True)
+            await check_status(response, f'получения {label}')
+            return parse_page(await read_json(response, label), label,
+                              etag, last_modified)
+
+    return await api_client.call(request, idempotent=True)
+
+
+def parse_page(data, label, etag=None, last_modified=None):
+    """Разбор страницы ответа API"""
+    if isinstance(data, list):
+        return Page(data, None, etag, last_modified)
+    results = data.get('results') if isinstance(data, dict) else None
+    if not isinstance(results, list):
+        raise ApiError(
+            f'Ответ API {label} не содержит ключа results '
+            'или не является списком'
+        )
+    logger.info('Получена страница %s: %s записей', label, len(results))
+    return Page(results, data.get('next'), etag, last_modified,
+                linked='next' in data)
+
+
+def query_params(filters=None, fields=None):
+    """Параметры запроса для фильтров и списка полей.
+
+    ``filters`` — {параметр фильтра: значение}, логические значения
+    передаются как true/false. Список ``fields`` передаётся
+    в ``API_FIELDS_PARAM``; без этого параметра API отдаёт все поля.
+    """
+    params = {}
+    for name, value in (filters or {}).items():
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        params[name] = value
+    if fields and API_FIELDS_PARAM:
+        params[API_FIELDS_PARAM] = ','.join(fields)
+    return params
+
+
+def next_page_request(url, params, page, page_size):
+    """Адрес и параметры следующей страницы либо (None, None)"""
+    if page.next_url:
+        # Адрес следующей страницы уже содержит все параметры
+        return page.next_url, None
+    if page.linked:
+        return None, None
+    # API без ссылок на страницы: следующая запрашивается по номеру,
+    # пока страница заполнена
+    if params is not None and len(page.results) >= page_size:
+        return url, dict(params, **{
+            API_PAGE_PARAM: params[API_PAGE_PARAM] + 1
+        })
+    return None, None
+
+
+async def iter_records(url, page_size=API_PAGE_SIZE,
+                       prefetch=API_PREFETCH_PAGES, params=None,
+                       label='записей', filters=None, fields=None):
+    """Постраничная выдача записей таблицы.
+
+    Страницы загружаются фоновой задачей не более чем на ``prefetch``
+    вперёд, поэтому потребитель обрабатывает записи по мере поступления,
+    а в памяти одновременно находится ограниченное число страниц.
+    Фильтры и список полей передаются API (см. ``query_params``).
+    Любая ошибка загрузки страницы передаётся потребителю и возбуждается
+    в нём, поэтому потребитель не ждёт страниц от завершившейся задачи.
+    """
+    pages = asyncio.Queue(maxsize=max(prefetch, 1))
+
+    async def produce():
+        page_url = url
+        page_params = dict(params or {}, **query_params(filters, fields))
+        page_params[API_PAGE_SIZE_PARAM] = page_size
+        page_params[API_PAGE_PARAM] = 1
+        try:
+            while page_url:
+                page = await fetch_page(page_url, page_params, label)
+                await pages.put(page.results)
+                page_url, page_params = next_page_request(
+                    page_url, page_params, page, page_size
+                )
+        except Exception as error:
+            await pages.put(error)
+            return
+        await pages.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            results = await pages.get()
+            if results is None:
+                break
+            if isinstance(results, Exception):
+                raise results
+            for record in results:
+                yield record
+    finally:
+        producer.cancel()
+
+
+def iter_posts(page_size=API_PAGE_SIZE, prefetch=API_PREFETCH_PAGES,
+               params=None, filters=None, fields=None):
+    """Постраничная выдача постов"""
+    return iter_records(API_URL_POST, page_size, prefetch, params,
+                        label='постов', filters=filters, fields=fields)
+
+
+def iter_users(page_size=API_PAGE_SIZE, prefetch=API_PREFETCH_PAGES,
+               params=None, filters=None, fields=None):
+    """Постраничная выдача пользователей"""
+    return iter_records(API_URL_USER, page_size, prefetch, params,
+                        label='пользователей', filters=filters,
+                        fields=fields)
+
+
+async def get_new_posts(since=None, etag=None, last_modified=None,
+                        fields=None):
+    """Запрос постов, созданных не раньше ``since``.
+
+    Первая страница запрашивается условно: если лента не изменилась,
+    API отвечает 304 и возвращается пустая страница с ``not_modified``.
+    Возвращает ``Page`` со всеми новыми постами; при ошибке вызывает
+    ``ApiError``.
+    """
+    filters = {API_POST_SINCE_PARAM: since} if since else None
+    params = {
+        API_PAGE_SIZE_PARAM: API_PAGE_SIZE,
+        API_PAGE_PARAM: 1,
+        API_POST_ORDER_PARAM: 'date_create',
+        **query_params(filters, fields)
+    }
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    first = await fetch_page(API_URL_POST, params, 'постов', headers)
+    if first.not_modified:
+        return first
+
+    posts = list(first.results)
+    page = first
+    url, params = next_page_request(API_URL_POST, params, page,
+                                    API_PAGE_SIZE)
+    while url:
+        page = await fetch_page(url, params, 'постов')
+        posts.extend(page.results)
+        url, params = next_page_request(url, params, page, API_PAGE_SIZE)
+    return Page(posts, None, first.etag, first.last_modified)
+
 
 async def get_posts():
     """Запрос на получение постов"""
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(API_URL_POST, headers=HEADERS) as response:
-                if response.status == 200:
-                    try:
-                        data = await response.json()
-                        logger.info(f'Полученные данные постов: {data}')
-                        if 'results' in data \
-                                and isinstance(data['results'], list):
-                            return data['results']
-                        else:
-                            logger.error(
-                                'Ответ API постов не содержит ключа results '
-                                'или не является списком'
-                            )
-                            return []
-                    except ValueError as error:
-                        logger.error(
-                            'Ошибка чтения ответа API постов: '
-                            f'{error}'
-                        )
-                        return []
-                else:
-                    logger.error(f'Ошибка получения постов: {response.status}')
-                    return []
-        except aiohttp.ClientError as error:
-            logger.error(f'Ошибка сети при получении постов: {error}')
-            return []
+    try:
+        return [post async for post in iter_posts()]
+    except ApiError as error:
+        logger.error('Ошибка получения постов: %s', error)
+        return []
 
 
 async def get_users():
     """Запрос к таблице пользователей"""
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(API_URL_USER, headers=HEADERS) as response:
-                try:
-                    result = await response.json()
-                    users = result.get('results', [])
-                    logger.info(f'Получен ответ API пользователей: {result}')
-                    if not isinstance(users, list):
-                        logging.error(
-                            'Ответ API пользователей не является списком'
-                        )
-                        return []
-                    return users
-                except ValueError as error:
-                    logger.error(
-                        f'Ошибка чтения ответа API пользователей: {error}'
-                    )
-                    return []
-                except Exception as e:
-                    logging.error(f'Неожиданная ошибка: {e}')
-                    return []
-        except aiohttp.ClientError as error:
-            logger.error(f'Ошибка сети при получении пользователей: {error}')
-            return []
-
-
-async def get_user(chat_id):
-    """Запрос к данным пользователя"""
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(
-                f'{API_URL_USER}/{chat_id}', headers=HEADERS
-            ) as response:
-                if response.status == 200:
-                    try:
-                        user_data = await response.json()
-                        return user_data
-                    except ValueError as error:
-                        logger.error(
-                            f'Ошибка чтения данных пользователя: {error}'
-                        )
-                        return {}
-                else:
-                    logger.error(
-                        'Ошибка получения данных пользователя: '
-                        f'{response.status}'
-                    )
-                    return {}
-        except aiohttp.ClientError as error:
-            logger.error(
-                f'Ошибка сети при получении данных пользователя: {error}'
-            )
-            return {}
+    try:
+        return [user async for user in iter_users()]
+    except ApiError as error:
+        logger.error('Ошибка получения пользователей: %s', error)
+        return []
+
+
+async def get_user(chat_id, fields=None):
+    """Запрос к данным пользователя.
+
+    Возвращает {} для неизвестного пользователя; при недоступности API
+    вызывает ``ApiError``, чтобы сбой не выглядел как новый пользователь.
+    Медленный запрос дублируется.
+    """
+    async def request():
+        async with api_client.session.get(
+            f'{API_URL_USER}/{chat_id}', params=query_params(fields=fields)
+        ) as response:
+            if response.status == 404:
+                return {}
+            await check_status(response, 'получения данных пользователя')
+            return await read_json(response, 'данных пользователя')
+
+    return await api_client.call(request, idempotent=True, hedge=True)
+
+
+async def create_user(data):
+    """Создание пользователя; при ошибке вызывает ``ApiError``"""
+    async def request():
+        async with api_client.session.post(
+            API_URL_USER, json=data
+        ) as response:
+            await check_status(response, 'сохранения данных пользователя',
+                               expected=(200, 201))
+            return await read_json(response, 'при сохранении пользователя')
+
+    return await api_client.call(request)
+
+
+async def patch_user(chat_id, data):
+    """Изменение пользователя; при ошибке вызывает ``ApiError``"""
+    async def request():
+        async with api_client.session.patch(
+            f'{API_URL_USER}/{chat_id}', json=data
+        ) as response:
+            await check_status(response, 'обновления данных пользователя')
+            return await read_json(response, 'при обновлении пользователя')
+
+    return await api_client.call(request)
+
+
+async def bulk_update_users(records):
+    """Изменение нескольких пользователей одним запросом.
+
+    ``records`` — список словарей с ключом id. Требует адреса
+    ``API_URL_USER_BULK``; при ошибке вызывает ``ApiError``.
+    """
+    async def request():
+        async with api_client.session.patch(
+            API_URL_USER_BULK, json=records
+        ) as response:
+            await check_status(response, 'пакетного обновления пользователей')
+            return await read_json(response,
+                                   'при пакетном обновлении пользователей')
+
+    return await api_client.call(request)
 
 
 async def store_user(chat_id, name):
@@ -105,76 +418,21 @@ async def store_user(chat_id, name):
         'id': chat_id,
         'name': name
     }
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(
-                API_URL_USER, headers=HEADERS, json=data
-            ) as response:
-                if response.status in (200, 201):
-                    try:
-                        return await response.json()
-                    except ValueError as error:
-                        logger.error(
-                            'Ошибка чтения ответа API при сохранении '
-                            f'пользователя: {error}'
-                        )
-                        return {}
-                else:
-                    response_text = await response.text()
-                    logger.error(
-                        'Ошибка сохранения данных пользователя: '
-                        f'{response.status}, ответ: {response_text}'
-                    )
-                    return {}
-        except aiohttp.ClientError as error:
-            logger.error(
-                f'Ошибка сети при сохранении данных пользователя: {error}'
-            )
-            return {}
+    try:
+        return await create_user(data)
+    except ApiError as error:
+        logger.error(str(error))
+        return {}
 
 
 async def update_user(chat_id, data):
     """Обновление данных пользователя"""
-    logging.info(
-        f'Отправка в БД данных пользователя {chat_id}: {data}'
-    )
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.patch(
-                f'{API_URL_USER}/{chat_id}', headers=HEADERS, json=data
-            ) as response:
-                response_text = await response.text()
-                logger.info(
-                    'Ответ от API при обновлении данных пользователя '
-                    f'{chat_id}: {response_text}'
-                )
-                if response.status == 200:
-                    try:
-                        updated_data = await response.json()
-                        logger.info(
-                            f'Данные пользователя обновлены: {updated_data}'
-                        )
-                        return updated_data
-                    except ValueError as error:
-                        logger.error(
-                            'Ошибка чтения ответа API при обновлении '
-                            f'пользователя: {error}'
-                        )
-                        return {}
-                else:
-                    logger.error(
-                        'Ошибка обновления данных пользователя: '
-                        f'{response.status}, ответ: {response_text}'
-                    )
-                    return {}
-        except aiohttp.ClientError as error:
-            logger.error(
-                f'Ошибка сети при обновлении данных пользователя: {error}'
-            )
-            return {}
-        except Exception as error:
-            logger.error(
-                'Неожиданная ошибка при обновлении данных пользователя: '
-                f'{error}'
-            )
-            return {}
+    logger.info('Отправка в БД данных пользователя %s: поля %s', chat_id,
+                ', '.join(data))
+    try:
+        updated_data = await patch_user(chat_id, data)
+    except ApiError as error:
+        logger.error(str(error))
+        return {}
+    logger.info('Данные пользователя %s обновлены', chat_id)
+    return updated_data
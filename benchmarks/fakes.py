@@ -0,0 +1,385 @@
+"""Локальные заменители JetAdmin API и Telegram Bot API для нагрузочных
+замеров.
+
+Оба сервера поддерживают задержку ответа, долю ошибок 5xx и долю
+ответов 429 и считают обращения по методам.
+"""
+import asyncio
+import itertools
+import json
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+# Формат поля date_create в ответах JetAdmin
+POST_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# Содержимое медиафайлов постов
+MEDIA_BODY = b'\0' * 64 * 1024
+MEDIA_ETAG = '"media-v1"'
+
+
+class Knobs:
+    """Параметры поведения заменителя"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 throttle_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class FakeService:
+    """Общая часть заменителей: задержка, сбои и счётчики вызовов"""
+
+    def __init__(self, knobs, seed=0):
+        self.knobs = knobs
+        # (метод, код ответа) -> число вызовов
+        self.calls = Counter()
+        self.random = random.Random(seed)
+
+    async def delay(self):
+        latency = self.knobs.latency
+        if self.knobs.jitter:
+            latency += self.random.uniform(0, self.knobs.jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def fault(self):
+        """Код ответа сбоя или None"""
+        roll = self.random.random()
+        if roll < self.knobs.throttle_rate:
+            return 429
+        if roll < self.knobs.throttle_rate + self.knobs.error_rate:
+            return 500
+        return None
+
+    def count(self, name, status):
+        self.calls[(name, status)] += 1
+
+    def report(self):
+        """Число вызовов: {метод: {код ответа: число}}"""
+        report = {}
+        for (name, status), count in sorted(self.calls.items()):
+            report.setdefault(name, {})[str(status)] = count
+        return report
+
+
+def synthetic_users(count, open_share=0.5, now=None, seed=0,
+                    inactive_share=0.0):
+    """Пользователи с разными часовыми поясами и окнами рассылки.
+
+    Примерно у ``open_share`` пользователей окно открыто в момент ``now``,
+    примерно ``inactive_share`` пользователей отключили рассылку.
+    """
+    now = now or datetime.utcnow()
+    rng = random.Random(seed)
+    now_minute = now.hour * 60 + now.minute
+    users = []
+    for chat_id in range(1, count + 1):
+        offset = rng.randrange(-12 * 60, 14 * 60 + 1, 30)
+        local_minute = (now_minute + offset) % (24 * 60)
+        length = rng.randrange(60, 8 * 60)
+        if rng.random() < open_share:
+            start = (local_minute - rng.randrange(0, length)) % (24 * 60)
+        else:
+            start = (local_minute + rng.randrange(1, 24 * 60 - length)) \
+                % (24 * 60)
+        end = (start + length) % (24 * 60)
+        sign = '-' if offset < 0 else '+'
+        users.append({
+            'id': chat_id,
+            'name': f'user{chat_id}',
+            'active': rng.random() >= inactive_share,
+            'start_time': f'{start // 60:02}:{start % 60:02}:00',
+            'end_time': f'{end // 60:02}:{end % 60:02}:00',
+            'time_zone': f'{sign}{abs(offset) // 60:02}:{abs(offset) % 60:02}',
+            'date_update': now.strftime(POST_DATE_FORMAT),
+        })
+    return users
+
+
+def synthetic_posts(count, images=1, videos=0, now=None):
+    """Посты за последние часы; медиафайлы отдаёт заменитель JetAdmin"""
+    now = now or datetime.utcnow()
+    posts = []
+    for post_id in range(1, count + 1):
+        posts.append({
+            'id': post_id,
+            'title': f'Пост {post_id}',
+            'text': 'Текст поста. ' * 20,
+            'date_create': (now - timedelta(minutes=10 * post_id)).strftime(
+                POST_DATE_FORMAT
+            ),
+            'image': [f'/media/image-{post_id}-{index}.jpg'
+                      for index in range(images)],
+            'video': [f'/media/video-{post_id}-{index}.mp4'
+                      for index in range(videos)],
+        })
+    return posts
+
+
+class FakeJetAdmin(FakeService):
+    """Заменитель таблиц постов и пользователей JetAdmin"""
+
+    def __init__(self, knobs, users=(), posts=(), page_param='page',
+                 page_size_param='_per_page',
+                 since_param='date_create__gte', fields_param='_fields',
+                 active_param='active', seed=0):
+        super().__init__(knobs, seed)
+        self.users = {user['id']: dict(user) for user in users}
+        self.posts = list(posts)
+        self.page_param = page_param
+        self.page_size_param = page_size_param
+        self.since_param = since_param
+        self.fields_param = fields_param
+        self.active_param = active_param
+        self.base_url = ''
+
+    def routes(self):
+        return [
+            web.get('/posts', self.list_posts),
+            web.get('/users', self.list_users),
+            web.post('/users', self.create_user),
+            web.patch('/users', self.bulk_update),
+            web.get('/users/{chat_id}', self.get_user),
+            web.patch('/users/{chat_id}', self.patch_user),
+            web.route('*', '/media/{name}', self.media),
+        ]
+
+    def absolute(self, post):
+        return dict(post,
+                    image=[self.base_url + url for url in post['image']],
+                    video=[self.base_url + url for url in post['video']])
+
+    async def guard(self, name):
+        await self.delay()
+        status = self.fault()
+        if status is not None:
+            self.count(name, status)
+            return web.json_response({'error': 'fake'}, status=status)
+        return None
+
+    def project(self, request, records):
+        """Записи только с полями из параметра списка полей"""
+        fields = request.query.get(self.fields_param)
+        if not fields:
+            return records
+        fields = fields.split(',')
+        return [{field: record[field] for field in fields if field in record}
+                for record in records]
+
+    def page(self, request, records):
+        page = int(request.query.get(self.page_param, 1))
+        size = int(request.query.get(self.page_size_param, len(records) or 1))
+        return records[(page - 1) * size:page * size]
+
+    async def list_posts(self, request):
+        failure = await self.guard('GET /posts')
+        if failure is not None:
+            return failure
+        since = request.query.get(self.since_param)
+        posts = sorted((post for post in self.posts
+                        if not since or post['date_create'] >= since),
+                       key=lambda post: post['date_create'])
+        self.count('GET /posts', 200)
+        posts = [self.absolute(post) for post in self.page(request, posts)]
+        return web.json_response(self.project(request, posts))
+
+    async def list_users(self, request):
+        failure = await self.guard('GET /users')
+        if failure is not None:
+            return failure
+        users = list(self.users.values())
+        active = request.query.get(self.active_param)
+        if active is not None:
+            users = [user for user in users
+                     if bool(user.get('active')) == (active == 'true')]
+        self.count('GET /users', 200)
+        return web.json_response(self.project(request,
+                                              self.page(request, users)))
+
+    async def get_user(self, request):
+        failure = await self.guard('GET /users/{id}')
+        if failure is not None:
+            return failure
+        user = self.users.get(int(request.match_info['chat_id']))
+        status = 200 if user is not None else 404
+        self.count('GET /users/{id}', status)
+        return web.json_response(
+            self.project(request, [user])[0] if user else {}, status=status
+        )
+
+    async def create_user(self, request):
+        failure = await self.guard('POST /users')
+        if failure is not None:
+            return failure
+        user = await request.json()
+        self.users[int(user['id'])] = user
+        self.count('POST /users', 201)
+        return web.json_response(user, status=201)
+
+    async def patch_user(self, request):
+        failure = await self.guard('PATCH /users/{id}')
+        if failure is not None:
+            return failure
+        chat_id = int(request.match_info['chat_id'])
+        user = self.users.setdefault(chat_id, {'id': chat_id})
+        user.update(await request.json())
+        self.count('PATCH /users/{id}', 200)
+        return web.json_response(user)
+
+    async def bulk_update(self, request):
+        failure = await self.guard('PATCH /users')
+        if failure is not None:
+            return failure
+        result = []
+        for record in await request.json():
+            user = self.users.setdefault(int(record['id']), {})
+            user.update(record)
+            result.append(user)
+        self.count('PATCH /users', 200)
+        return web.json_response(result)
+
+    async def media(self, request):
+        name = f'{request.method} /media'
+        await self.delay()
+        # Содержимое файлов не меняется: условный запрос получает 304
+        headers = {'ETag': MEDIA_ETAG}
+        if request.headers.get('If-None-Match') == MEDIA_ETAG:
+            self.count(name, 304)
+            return web.Response(status=304, headers=headers)
+        self.count(name, 200)
+        if request.method == 'HEAD':
+            headers['Content-Length'] = str(len(MEDIA_BODY))
+            return web.Response(headers=headers)
+        return web.Response(body=MEDIA_BODY, headers=headers)
+
+
+class FakeBotApi(FakeService):
+    """Заменитель Telegram Bot API.
+
+    Отвечает на методы отправки сообщениями с file_id, ``blocked_rate``
+    задаёт долю чатов, заблокировавших бота.
+    """
+
+    def __init__(self, knobs, blocked_rate=0.0, seed=0):
+        super().__init__(knobs, seed)
+        self.blocked_rate = blocked_rate
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+
+    def routes(self):
+        return [web.post('/bot{token}/{method}', self.call)]
+
+    async def params(self, request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        form = await request.post()
+        return {key: value for key, value in form.items()}
+
+    def message(self, chat_id, kind=None):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': 0,
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }
+        file_id = f'file-{next(self.file_ids)}'
+        if kind == 'photo':
+            message['photo'] = [{'file_id': file_id,
+                                 'file_unique_id': file_id,
+                                 'width': 1, 'height': 1}]
+        elif kind == 'video':
+            message['video'] = {'file_id': file_id,
+                                'file_unique_id': file_id,
+                                'width': 1, 'height': 1, 'duration': 1}
+        return message
+
+    def is_blocked(self, chat_id):
+        # Одни и те же чаты блокируют бота при каждом запросе
+        return random.Random(int(chat_id)).random() < self.blocked_rate
+
+    async def call(self, request):
+        method = request.match_info['method']
+        params = await self.params(request)
+        await self.delay()
+        if method in ('getMe', 'setWebhook', 'deleteWebhook'):
+            self.count(method, 200)
+            result = True
+            if method == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'bench',
+                          'username': 'bench_bot'}
+            return web.json_response({'ok': True, 'result': result})
+
+        status = self.fault()
+        if status == 429:
+            self.count(method, 429)
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': 'Too Many Requests: retry after '
+                               f'{self.knobs.retry_after}',
+                'parameters': {'retry_after': self.knobs.retry_after},
+            }, status=429)
+        if status is not None:
+            self.count(method, status)
+            return web.json_response({
+                'ok': False, 'error_code': status,
+                'description': 'Internal Server Error',
+            }, status=status)
+
+        chat_id = params.get('chat_id', 0)
+        if self.is_blocked(chat_id):
+            self.count(method, 403)
+            return web.json_response({
+                'ok': False, 'error_code': 403,
+                'description': 'Forbidden: bot was blocked by the user',
+            }, status=403)
+
+        self.count(method, 200)
+        if method == 'sendMediaGroup':
+            media = params.get('media')
+            if isinstance(media, str):
+                media = json.loads(media)
+            result = [self.message(chat_id, item.get('type'))
+                      for item in media]
+        elif method == 'sendPhoto':
+            result = self.message(chat_id, 'photo')
+        elif method == 'sendVideo':
+            result = self.message(chat_id, 'video')
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self.message(chat_id)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+async def start_server(services, host='127.0.0.1', port=0):
+    """Запуск заменителей на одном сервере; возвращает (runner, адрес).
+
+    ``services`` — словарь {имя: заменитель}; счётчики вызовов всех
+    заменителей отдаются по адресу ``/_stats``.
+    """
+    async def stats(request):
+        return web.json_response({name: service.report()
+                                  for name, service in services.items()})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_get('/_stats', stats)
+    for service in services.values():
+        app.add_routes(service.routes())
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    sockets = site._server.sockets
+    address = f'http://{host}:{sockets[0].getsockname()[1]}'
+    for service in services.values():
+        service.base_url = address
+    return runner, address
@@ -0,0 +1,304 @@
+"""Нагрузочные замеры рассылки и обработчиков диалога.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.run --users 1000 10000 100000 --output bench.json
+
+Для каждого размера базы пользователей поднимаются заменители JetAdmin
+и Bot API, а бот запускается в отдельном процессе, чтобы замер пиковой
+памяти и состояние модулей не зависели от других сценариев. Результаты
+выводятся в формате JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks.fakes import (
+    FakeBotApi, FakeJetAdmin, Knobs, start_server, synthetic_posts,
+    synthetic_users
+)
+
+# Корень репозитория: дочерний процесс импортирует модули бота оттуда
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sent(stats):
+    """Число успешных отправок Bot API"""
+    return sum(statuses.get('200', 0)
+               for method, statuses in stats.get('telegram', {}).items()
+               if method.startswith('send'))
+
+
+def api_calls(stats):
+    """Число обращений к JetAdmin API без загрузки медиафайлов"""
+    return sum(sum(statuses.values())
+               for method, statuses in stats.get('jetadmin', {}).items()
+               if not method.endswith('/media'))
+
+
+def handler_updates(chat_ids):
+    """Записанные обновления диалога смены времени и часового пояса"""
+    update_id = 0
+    for chat_id in chat_ids:
+        for text in ('/change_time', '09:00-18:00',
+                     '/change_time_zone', '+03:00'):
+            update_id += 1
+            message = {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False,
+                         'first_name': f'user{chat_id}'},
+                'text': text,
+            }
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                        'length': len(text)}]
+            yield {'update_id': update_id, 'message': message}
+
+
+async def run_child(args):
+    """Замер в дочернем процессе; окружение задано родительским"""
+    from types import SimpleNamespace
+
+    import aiohttp
+    from telegram import Update
+
+    import yacrowdbot
+    from logs import setup_logging
+
+    setup_logging()
+    stats_url = os.environ['BENCH_STATS_URL']
+
+    async def stats():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(stats_url) as response:
+                return await response.json()
+
+    result = {}
+    app = yacrowdbot.build_application()
+    await app.initialize()
+    started = time.perf_counter()
+    await yacrowdbot.on_startup(app)
+    result['load_seconds'] = time.perf_counter() - started
+    now = datetime.now(timezone.utc)
+    result['eligible_users'] = len(yacrowdbot.window_index.open_at(
+        now.hour * 60 + now.minute
+    ))
+
+    chat_ids = list(range(1, min(args.handler_users, args.child_users) + 1))
+    updates = [Update.de_json(data, app.bot)
+               for data in handler_updates(chat_ids)]
+
+    async def run_handlers():
+        latencies = []
+        started = time.perf_counter()
+        for update in updates:
+            update_started = time.perf_counter()
+            await app.process_update(update)
+            latencies.append(time.perf_counter() - update_started)
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return {
+            'updates': len(updates),
+            'seconds': elapsed,
+            'mean_seconds': elapsed / len(updates) if updates else 0.0,
+            'p95_seconds': (latencies[int(len(latencies) * 0.95)]
+                            if latencies else 0.0),
+        }
+
+    context = SimpleNamespace(bot=app.bot)
+    result['ticks'] = []
+    handlers = None
+    for tick in range(args.ticks):
+        before = await stats()
+        started = time.perf_counter()
+        if tick == 0 and args.handlers_during_tick:
+            # Диалог настроек идёт одновременно с рассылкой первого тика
+            handlers = asyncio.ensure_future(run_handlers())
+        await yacrowdbot.send_news(context)
+        seconds = time.perf_counter() - started
+        after = await stats()
+        sends = sent(after) - sent(before)
+        result['ticks'].append({
+            'seconds': seconds,
+            'sends': sends,
+            'sends_per_second': sends / seconds if seconds else 0.0,
+            'jetadmin_calls': api_calls(after) - api_calls(before),
+        })
+
+    if handlers is not None:
+        result['handlers'] = await handlers
+        result['handlers']['during_tick'] = True
+    else:
+        result['handlers'] = await run_handlers()
+
+    await yacrowdbot.on_shutdown(app)
+    await app.shutdown()
+    # В Linux ru_maxrss измеряется в килобайтах
+    result['peak_rss_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF
+    ).ru_maxrss
+    print(json.dumps(result))
+
+
+async def run_scenario(args, users):
+    """Сценарий с базой из ``users`` пользователей"""
+    jetadmin = FakeJetAdmin(
+        Knobs(args.jetadmin_latency, args.jitter, args.error_rate,
+              args.throttle_rate, args.retry_after),
+        users=synthetic_users(users, args.open_share, seed=args.seed,
+                              inactive_share=args.inactive_share),
+        posts=synthetic_posts(args.posts, args.images, args.videos),
+        seed=args.seed
+    )
+    telegram = FakeBotApi(
+        Knobs(args.telegram_latency, args.jitter, args.error_rate,
+              args.throttle_rate, args.retry_after),
+        blocked_rate=args.blocked_rate, seed=args.seed
+    )
+    runner, address = await start_server({'jetadmin': jetadmin,
+                                          'telegram': telegram})
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                os.environ,
+                API_TOKEN='123456:bench',
+                JETADMIN_API_KEY='bench',
+                API_URL_POST=f'{address}/posts',
+                API_URL_USER=f'{address}/users',
+                TELEGRAM_BASE_URL=f'{address}/bot',
+                BENCH_STATS_URL=f'{address}/_stats',
+                LEDGER_PATH=os.path.join(directory, 'ledger.sqlite3'),
+                FILE_ID_CACHE_PATH=os.path.join(directory,
+                                                'file_ids.sqlite3'),
+                BROADCAST_QUEUE_PATH=os.path.join(directory,
+                                                  'broadcast.sqlite3'),
+                MEDIA_DIR=os.path.join(directory, 'media'),
+                SEND_RATE=str(args.send_rate),
+                SEND_CHAT_INTERVAL=str(args.chat_interval),
+                SEND_WORKERS=str(args.send_workers),
+                BROADCAST_WORKERS='0',
+                UPDATE_MODE='polling',
+                METRICS_PORT='0',
+            )
+            log = (open(os.path.join(args.log_dir, f'bench-{users}.log'), 'w')
+                   if args.log_dir else subprocess.DEVNULL)
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    sys.executable, '-m', 'benchmarks.run', '--child',
+                    '--child-users', str(users),
+                    '--ticks', str(args.ticks),
+                    '--handler-users', str(args.handler_users),
+                    *(['--handlers-during-tick']
+                      if args.handlers_during_tick else []),
+                    cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=log
+                )
+                started = time.perf_counter()
+                stdout, _ = await asyncio.wait_for(process.communicate(),
+                                                   args.timeout)
+                wall_seconds = time.perf_counter() - started
+            finally:
+                if log is not subprocess.DEVNULL:
+                    log.close()
+    finally:
+        await runner.cleanup()
+
+    scenario = {'users': users, 'returncode': process.returncode,
+                'wall_seconds': wall_seconds}
+    if process.returncode == 0:
+        scenario.update(json.loads(stdout.decode().strip().splitlines()[-1]))
+    scenario['api_calls'] = {'jetadmin': jetadmin.report(),
+                             'telegram': telegram.report()}
+    return scenario
+
+
+async def run(args):
+    report = {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'settings': {key: value for key, value in vars(args).items()
+                     if not key.startswith('child')
+                     and key not in ('output', 'log_dir')},
+        'scenarios': [],
+    }
+    for users in args.users:
+        print(f'Сценарий: {users} пользователей', file=sys.stderr)
+        report['scenarios'].append(await run_scenario(args, users))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output)
+    print(output)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Нагрузочные замеры рассылки с заменителями API'
+    )
+    parser.add_argument('--users', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='размеры базы пользователей')
+    parser.add_argument('--open-share', type=float, default=0.5,
+                        help='доля пользователей с открытым окном')
+    parser.add_argument('--inactive-share', type=float, default=0.0,
+                        help='доля пользователей, отключивших рассылку')
+    parser.add_argument('--posts', type=int, default=3)
+    parser.add_argument('--images', type=int, default=1,
+                        help='изображений в посте')
+    parser.add_argument('--videos', type=int, default=0,
+                        help='видео в посте')
+    parser.add_argument('--ticks', type=int, default=2,
+                        help='тиков рассылки подряд; повторные тики '
+                             'показывают стоимость тика без отправок')
+    parser.add_argument('--handler-users', type=int, default=100,
+                        help='пользователей, проходящих диалог настроек')
+    parser.add_argument('--handlers-during-tick', action='store_true',
+                        help='проходить диалог настроек во время рассылки '
+                             'первого тика')
+    parser.add_argument('--jetadmin-latency', type=float, default=0.01)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--blocked-rate', type=float, default=0.0,
+                        help='доля чатов, заблокировавших бота')
+    parser.add_argument('--send-rate', type=float, default=1000,
+                        help='SEND_RATE бота; по умолчанию выше лимита '
+                             'Telegram, чтобы замерять сам код')
+    parser.add_argument('--chat-interval', type=float, default=0.0,
+                        help='SEND_CHAT_INTERVAL бота')
+    parser.add_argument('--send-workers', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=3600,
+                        help='предел времени сценария в секундах')
+    parser.add_argument('--output', help='файл для отчёта JSON')
+    parser.add_argument('--log-dir', help='каталог для журналов бота')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--child-users', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        asyncio.run(run_child(args))
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,5 @@
 import os
 from dotenv import load_dotenv
-from telegram.request import HTTPXRequest
 
 # Загрузка переменных окружения из файла .env
 load_dotenv()
@@ -10,6 +9,12 @@ API_TOKEN = os.getenv('API_TOKEN')
 JETADMIN_API_KEY = os.getenv('JETADMIN_API_KEY')
 API_URL_POST = os.getenv('API_URL_POST')
 API_URL_USER = os.getenv('API_URL_USER')
+# Необязательный адрес пакетного обновления пользователей
+API_URL_USER_BULK = os.getenv('API_URL_USER_BULK')
+
+# Адрес Bot API, например локального сервера Bot API
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL',
+                              'https://api.telegram.org/bot')
 
 # Заголовки для запросов к API
 HEADERS = {
@@ -17,13 +22,140 @@ HEADERS = {
     'Content-Type': 'application/json'
 }
 
-# Настройка тайм-аутов и лимитов для HTTPXRequest
-request = HTTPXRequest(
-    connect_timeout=10.0,
-    read_timeout=300.0,
-    write_timeout=300.0,
-    pool_timeout=5.0
+# Настройка пула соединений к JetAdmin API
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', 100))
+API_POOL_PER_HOST = int(os.getenv('API_POOL_PER_HOST', 30))
+API_KEEPALIVE_TIMEOUT = float(os.getenv('API_KEEPALIVE_TIMEOUT', 30))
+API_DNS_CACHE_TTL = int(os.getenv('API_DNS_CACHE_TTL', 300))
+
+# Устойчивость к сбоям JetAdmin API: тайм-аут запроса, повторы GET,
+# автомат защиты и дублирование медленных запросов
+API_TIMEOUT = float(os.getenv('API_TIMEOUT', 15))
+API_RETRIES = int(os.getenv('API_RETRIES', 3))
+API_RETRY_BASE_DELAY = float(os.getenv('API_RETRY_BASE_DELAY', 0.5))
+API_RETRY_MAX_DELAY = float(os.getenv('API_RETRY_MAX_DELAY', 5))
+API_BREAKER_THRESHOLD = int(os.getenv('API_BREAKER_THRESHOLD', 5))
+API_BREAKER_RESET = float(os.getenv('API_BREAKER_RESET', 30))
+API_HEDGE_DELAY = float(os.getenv('API_HEDGE_DELAY', 0.5))
+
+# Постраничная загрузка таблиц JetAdmin
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 500))
+API_PREFETCH_PAGES = int(os.getenv('API_PREFETCH_PAGES', 2))
+API_PAGE_PARAM = os.getenv('API_PAGE_PARAM', 'page')
+API_PAGE_SIZE_PARAM = os.getenv('API_PAGE_SIZE_PARAM', '_per_page')
+
+# Инкрементальная загрузка постов
+API_POST_SINCE_PARAM = os.getenv('API_POST_SINCE_PARAM', 'date_create__gte')
+API_POST_ORDER_PARAM = os.getenv('API_POST_ORDER_PARAM', '_order_by')
+POSTS_WINDOW_HOURS = int(os.getenv('POSTS_WINDOW_HOURS', 24))
+
+# Расписание рассылки: тик запускается при открытии окон пользователей
+# и появлении новых постов; проверка новых постов и наибольшая пауза
+# между тиками (с)
+POSTS_POLL_INTERVAL = float(os.getenv('POSTS_POLL_INTERVAL', 60))
+TICK_MAX_INTERVAL = float(os.getenv('TICK_MAX_INTERVAL', 600))
+
+# Локальное зеркало пользователей
+USER_UPDATED_FIELD = os.getenv('USER_UPDATED_FIELD', 'date_update')
+API_USER_UPDATED_SINCE_PARAM = os.getenv(
+    'API_USER_UPDATED_SINCE_PARAM', f'{USER_UPDATED_FIELD}__gte'
 )
+ROSTER_SYNC_INTERVAL = int(os.getenv('ROSTER_SYNC_INTERVAL', 60))
+# Интервал полной перезагрузки, если в таблице нет поля обновления
+ROSTER_RELOAD_INTERVAL = int(os.getenv('ROSTER_RELOAD_INTERVAL', 600))
+
+# Фильтры и выбор полей в запросах к JetAdmin: параметр списка полей
+# (пустой — запрашиваются все поля), параметр фильтра активных
+# пользователей (пустой — загружаются все) и поля таблиц через запятую
+API_FIELDS_PARAM = os.getenv('API_FIELDS_PARAM', '_fields')
+API_USER_ACTIVE_PARAM = os.getenv('API_USER_ACTIVE_PARAM', 'active')
+API_USER_FIELDS = [field for field in os.getenv(
+    'API_USER_FIELDS', 'id,name,active,start_time,end_time,time_zone'
+).split(',') if field]
+API_POST_FIELDS = [field for field in os.getenv(
+    'API_POST_FIELDS', 'id,date_create,title,text,image,video'
+).split(',') if field]
+
+# Отложенная запись изменений пользователей
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 100))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', 1.0))
+WRITE_CONCURRENCY = int(os.getenv('WRITE_CONCURRENCY', 8))
+
+# Журнал доставленных постов
+LEDGER_PATH = os.getenv('LEDGER_PATH', 'data/ledger.sqlite3')
+LEDGER_TTL_HOURS = int(os.getenv('LEDGER_TTL_HOURS', 48))
+
+# Планировщик отправки сообщений в Telegram
+SEND_RATE = float(os.getenv('SEND_RATE', 30))
+SEND_CHAT_INTERVAL = float(os.getenv('SEND_CHAT_INTERVAL', 1.0))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 30))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+SEND_QUEUE_SIZE = int(os.getenv('SEND_QUEUE_SIZE', 1000))
+
+# Загрузка медиафайлов постов
+MEDIA_DIR = os.getenv('MEDIA_DIR', '/mnt/data')
+MEDIA_CONCURRENCY = int(os.getenv('MEDIA_CONCURRENCY', 4))
+MEDIA_CHUNK_SIZE = int(os.getenv('MEDIA_CHUNK_SIZE', 64 * 1024))
+MEDIA_TIMEOUT = float(os.getenv('MEDIA_TIMEOUT', 300))
+# Кэш загруженных медиафайлов в MEDIA_DIR: предельный объём в байтах
+# и интервал проверки изменений файла по ETag/Last-Modified в секундах
+MEDIA_CACHE_BYTES = int(os.getenv('MEDIA_CACHE_BYTES', 2 * 1024 ** 3))
+MEDIA_REVALIDATE_INTERVAL = float(os.getenv('MEDIA_REVALIDATE_INTERVAL',
+                                            300))
+FILE_ID_CACHE_PATH = os.getenv('FILE_ID_CACHE_PATH', 'data/file_ids.sqlite3')
+
+# Шардированная рассылка: число процессов-исполнителей (0 — рассылка
+# в основном процессе), запуск исполнителей основным процессом,
+# очередь заданий (outbox), размер пачки, пауза опроса, срок захвата
+# задания, число попыток доставки и пауза перед повтором
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 0))
+BROADCAST_SPAWN_WORKERS = os.getenv(
+    'BROADCAST_SPAWN_WORKERS', 'true'
+).lower() in ('1', 'true', 'yes')
+BROADCAST_QUEUE_BACKEND = os.getenv('BROADCAST_QUEUE_BACKEND', 'sqlite')
+BROADCAST_QUEUE_PATH = os.getenv('BROADCAST_QUEUE_PATH',
+                                 'data/broadcast.sqlite3')
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', 100))
+BROADCAST_POLL_INTERVAL = float(os.getenv('BROADCAST_POLL_INTERVAL', 1.0))
+BROADCAST_LEASE = float(os.getenv('BROADCAST_LEASE', 600))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', 5))
+BROADCAST_RETRY_DELAY = float(os.getenv('BROADCAST_RETRY_DELAY', 60))
+
+# Получение обновлений: polling или webhook, число одновременно
+# обрабатываемых обновлений разных чатов
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 64))
+
+# Встроенный сервер вебхука: публичный адрес для регистрации в Telegram
+# (без него вебхук не регистрируется), адрес и порт сервера, путь,
+# секрет, число соединений Telegram и предел очереди обновлений
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+
+# Сервер метрик Prometheus (порт 0 — по умолчанию — отключает метрики);
+# исполнители шардов слушают следующие порты по порядку номеров шардов
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# Логирование: уровень, необязательный файл журнала и выборка
+# повторяющихся сообщений об отправке (1 — записывать все)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE')
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', 100))
+
+# Пулы соединений с Bot API: получение обновлений, ответы пользователям
+# и рассылка; версия HTTP — 1.1 или 2 (для HTTP/2 нужен
+# python-telegram-bot[http2])
+TELEGRAM_HTTP_VERSION = os.getenv('TELEGRAM_HTTP_VERSION', '1.1')
+TELEGRAM_UPDATES_POOL = int(os.getenv('TELEGRAM_UPDATES_POOL', 1))
+TELEGRAM_INTERACTIVE_POOL = int(os.getenv('TELEGRAM_INTERACTIVE_POOL', 16))
+TELEGRAM_BROADCAST_POOL = int(os.getenv('TELEGRAM_BROADCAST_POOL',
+                                        SEND_WORKERS))
 
 # Убедитесь, что все необходимые переменные окружения загружены правильно
 if not all([API_TOKEN, JETADMIN_API_KEY, API_URL_POST, API_URL_USER]):
@@ -31,3 +163,11 @@ if not all([API_TOKEN, JETADMIN_API_KEY, API_URL_POST, API_URL_USER]):
         'Не удалось загрузить одну или несколько переменных окружения.'
         'Проверьте файл .env'
     )
+
+if UPDATE_MODE not in ('polling', 'webhook'):
+    raise EnvironmentError(f'Неизвестный режим UPDATE_MODE: {UPDATE_MODE}')
+
+if UPDATE_MODE == 'webhook' and not WEBHOOK_SECRET_TOKEN:
+    raise EnvironmentError(
+        'Для режима webhook необходимо задать WEBHOOK_SECRET_TOKEN.'
+    )
@@ -0,0 +1,228 @@
+import logging
+from pathlib import Path
+
+from telegram.error import BadRequest, TelegramError
+
+from albums import input_media
+from logs import SamplingFilter
+from media import file_id_cache, media_fetcher
+from metrics import posts_delivered, posts_failed, users_blocked
+from roster import roster
+from sender import send_scheduler
+
+logger = logging.getLogger(__name__)
+# Сообщения об отправке каждому пользователю записываются выборочно
+logger.addFilter(SamplingFilter())
+
+
+async def handle_block_error(chat_id):
+    """Обработка ошибки блокировки бота пользователем"""
+    try:
+        await roster.update(chat_id, {'active': False})
+        logger.info('Пользователь %s заблокировал бота. Маркер активности '
+                    'поставлен в очередь записи в БД.', chat_id)
+    except Exception as e:
+        logger.error('Ошибка обновления статуса пользователя %s: %s',
+                     chat_id, e)
+
+
+class NotDelivered(Exception):
+    """Ни одно сообщение поста не дошло до пользователя"""
+
+
+class Delivery:
+    """Отправка скомпилированных постов пользователям.
+
+    Результаты проверки изображений и пути к видео переиспользуются
+    всеми отправками одного экземпляра и сбрасываются вызовом
+    ``cleanup``; сами видео остаются в кэше медиафайлов. Чаты,
+    заблокировавшие бота, последняя ошибка отправки в чат и число
+    отправленных частей недоставленного поста запоминаются для обработки
+    заданий рассылки.
+    """
+
+    def __init__(self, bot, scheduler=send_scheduler):
+        self.bot = bot
+        self.scheduler = scheduler
+        # Адрес видео -> запись кэша медиафайлов
+        self.videos = {}
+        # Адрес изображения -> доступно ли оно
+        self.image_checks = {}
+        # chat id чатов, заблокировавших бота
+        self.blocked = set()
+        # chat id -> текст последней ошибки отправки
+        self.errors = {}
+        # chat id -> число полностью отправленных частей поста
+        self.progress = {}
+
+    async def image_source(self, image_url):
+        """Адрес изображения, если оно доступно"""
+        # Проверка доступности без загрузки изображения
+        if image_url not in self.image_checks:
+            self.image_checks[image_url] = await media_fetcher.check(
+                image_url
+            )
+        if not self.image_checks[image_url]:
+            logger.error('Изображение недоступно: %s', image_url)
+            return None
+        return image_url
+
+    async def video(self, video_url):
+        """Запись кэша для видео, загруженного или проверенного в кэше"""
+        # Кэш проверяется один раз за время жизни экземпляра
+        if video_url not in self.videos:
+            self.videos[video_url] = await media_fetcher.fetch(video_url)
+        return self.videos[video_url]
+
+    async def video_source(self, video_url):
+        """Путь к загруженному видео.
+
+        Передаётся путь, а не открытый файл, чтобы при повторной
+        отправке файл читался заново.
+        """
+        return Path((await self.video(video_url)).path)
+
+    async def media_key(self, kind, source):
+        """Ключ file_id медиафайла.
+
+        file_id видео привязан к хешу содержимого: если файл по адресу
+        изменился, новое видео загружается в Telegram заново. Изображения
+        Telegram получает по адресу сам, их ключ — адрес.
+        """
+        if kind == 'video':
+            return kind, 'sha256:' + (await self.video(source)).digest
+        return kind, source
+
+    async def media_source(self, kind, source):
+        """Исходные данные медиафайла для первой отправки"""
+        if kind == 'video':
+            return await self.video_source(source)
+        return await self.image_source(source)
+
+    async def send_media(self, user_id, media, caption):
+        """Отправка одного медиафайла или альбома"""
+        if len(media) == 1:
+            kind, file = media[0]
+            method = (self.bot.send_video if kind == 'video'
+                      else self.bot.send_photo)
+            message = await self.scheduler.send(
+                method, chat_id=user_id, caption=caption, **{kind: file}
+            )
+            return [message]
+        return await self.scheduler.send(
+            self.bot.send_media_group, chat_id=user_id,
+            media=[input_media(kind, file, caption if index == 0 else None)
+                   for index, (kind, file) in enumerate(media)]
+        )
+
+    async def send_text(self, user_id, text):
+        """Отправка текста отдельным сообщением; число сообщений"""
+        if not text or text.isspace():
+            return 0
+        await self.scheduler.send(self.bot.send_message,
+                                  chat_id=user_id, text=text)
+        return 1
+
+    async def send_part(self, user_id, media, caption):
+        """Отправка медиачасти поста; число доставленных сообщений"""
+        keys = [await self.media_key(kind, source) for kind, source in media]
+        messages = await file_id_cache.send_group(
+            media, lambda files: self.send_media(user_id, files, caption),
+            self.media_source, keys
+        )
+        if not messages:
+            # Все файлы недоступны, но текст поста всё равно отправляется
+            return await self.send_text(user_id, caption)
+        return len(messages)
+
+    async def send_media_part(self, user_id, media, caption):
+        """Отправка медиачасти с запасными вариантами.
+
+        Если Telegram отклонил альбом (``BadRequest``), файлы
+        отправляются по одному: отклонённые файлы пропускаются, а текст,
+        не попавший в подпись, отправляется отдельным сообщением.
+        Остальные ошибки (сеть, тайм-аут, RetryAfter, загрузка видео)
+        пробрасываются: задание повторяется с этой части, и уже
+        доставленные, но не подтверждённые файлы не дублируются.
+        Возвращает число доставленных сообщений.
+        """
+        try:
+            return await self.send_part(user_id, media, caption)
+        except BadRequest as error:
+            if len(media) == 1:
+                logger.error('Telegram отклонил файл %s: %s',
+                             media[0][1], error)
+                return await self.send_text(user_id, caption)
+            logger.error('Telegram отклонил альбом для пользователя %s: '
+                         '%s. Файлы будут отправлены по одному',
+                         user_id, error)
+
+        # Запасной вариант: файлы альбома отправляются по одному
+        sent = 0
+        for kind, source in media:
+            try:
+                count = await self.send_part(user_id, [(kind, source)],
+                                             caption)
+            except BadRequest as error:
+                logger.error('Telegram отклонил файл %s: %s', source, error)
+                continue
+            if count:
+                sent += count
+                caption = None
+        return sent + await self.send_text(user_id, caption)
+
+    async def send_post(self, user_id, post_id, parts, start=0):
+        """Асинхронная отправка постов.
+
+        Отправка начинается с части ``start``: предыдущие части уже
+        отправлены прошлой попыткой. Число полностью отправленных частей
+        записывается в ``progress``. Если ни одно сообщение поста не
+        дошло до пользователя, вызывается ``NotDelivered``.
+        """
+        logger.info('Отправка поста пользователю %s: %s', user_id, post_id)
+        sent = 0
+        self.progress[user_id] = start
+        for index, part in enumerate(parts[start:], start + 1):
+            if part.media:
+                sent += await self.send_media_part(user_id, part.media,
+                                                   part.text)
+            else:
+                sent += await self.send_text(user_id, part.text)
+            self.progress[user_id] = index
+        if parts and not sent and not start:
+            raise NotDelivered(
+                f'Ни одно сообщение поста {post_id} не доставлено'
+            )
+
+    async def deliver(self, user_id, post_id, parts, start=0):
+        """Отправка поста с обработкой ошибок; True, если пост доставлен"""
+        try:
+            await self.send_post(user_id, post_id, parts, start)
+            posts_delivered.inc()
+            return True
+
+        except TelegramError as error:
+            self.errors[user_id] = str(error)
+            if 'blocked by the user' in str(error):
+                users_blocked.inc()
+                self.blocked.add(user_id)
+                await handle_block_error(user_id)
+            else:
+                posts_failed.inc()
+                logger.error('Ошибка при отправке поста пользователю %s: %s',
+                             user_id, error)
+
+        except Exception as e:
+            self.errors[user_id] = str(e) or type(e).__name__
+            posts_failed.inc()
+            logger.error('Неизвестная ошибка при отправке поста пользователю '
+                         '%s: %s', user_id, e)
+        return False
+
+    def cleanup(self):
+        """Сброс результатов проверок и записей о видео"""
+        self.videos.clear()
+        self.image_checks.clear()
+        self.blocked.clear()
+        self.errors.clear()
+        self.progress.clear()
@@ -0,0 +1,130 @@
+import logging
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+import pytz
+
+from api import ApiError, get_new_posts
+from config import API_POST_FIELDS, POSTS_WINDOW_HOURS
+from logs import describe
+from records import POST_DATE_FORMAT, PostRecord
+
+logger = logging.getLogger(__name__)
+
+
+class PreparedPosts:
+    """Посты тика, отсортированные по времени создания.
+
+    Каждый пост разобран один раз; выборка постов не старше заданного
+    момента выполняется двоичным поиском по меткам времени.
+    """
+
+    __slots__ = ('timestamps', 'posts')
+
+    def __init__(self, posts=()):
+        posts = sorted(posts, key=lambda post: (post.timestamp, post.id))
+        # Метки времени создания (секунды UTC) и записи постов в том же
+        # порядке
+        self.timestamps = [post.timestamp for post in posts]
+        self.posts = posts
+
+    def __len__(self):
+        return len(self.posts)
+
+    def since(self, cutoff):
+        """Посты, созданные не раньше метки времени cutoff"""
+        return self.posts[bisect_left(self.timestamps, cutoff):]
+
+
+class PostFeed:
+    """Инкрементальная лента постов за скользящее окно.
+
+    Лента помнит самый новый увиденный пост и запрашивает у API только
+    более поздние записи, передавая ETag/Last-Modified предыдущего ответа.
+    Посты, вышедшие за пределы окна, удаляются из локальной копии.
+    Каждый пост разбирается в ``PostRecord`` один раз при получении.
+    """
+
+    def __init__(self, window=timedelta(hours=POSTS_WINDOW_HOURS)):
+        self.window = window
+        # id поста -> запись поста
+        self.posts = {}
+        # Самый новый увиденный пост: (метка времени, id, исходная
+        # date_create)
+        self.cursor = None
+        self.etag = None
+        self.last_modified = None
+        # Увеличивается при каждом появлении новых постов
+        self.version = 0
+
+    def since(self, now_utc):
+        """Нижняя граница запроса новых постов"""
+        if self.cursor is not None:
+            # Граница включительная: посты с той же датой отсекаются по id
+            return self.cursor[2]
+        return (now_utc - self.window).strftime(POST_DATE_FORMAT)
+
+    def add(self, post, cutoff=None):
+        """Добавление поста в окно; False для некорректных и старых постов.
+
+        ``cutoff`` — метка времени UTC начала окна.
+        """
+        if not (isinstance(post, dict) and 'id' in post
+                and 'date_create' in post
+                and 'title' in post and 'text' in post):
+            return False
+        try:
+            record = PostRecord(post)
+        except (TypeError, ValueError) as error:
+            logger.error('Некорректная дата поста %s: %s', post['id'], error)
+            return False
+        if cutoff is not None and record.timestamp < cutoff:
+            return False
+        self.posts[record.id] = record
+        if (self.cursor is None
+                or (record.timestamp, record.id) > self.cursor[:2]):
+            self.cursor = (record.timestamp, record.id, record.date_create)
+        return True
+
+    def expire(self, now_utc):
+        """Удаление постов старше окна"""
+        cutoff = (now_utc - self.window).timestamp()
+        stale = [post_id for post_id, post in self.posts.items()
+                 if post.timestamp < cutoff]
+        for post_id in stale:
+            del self.posts[post_id]
+
+    async def refresh(self, now_utc=None):
+        """Загрузка новых постов; возвращает подготовленные посты окна"""
+        now_utc = now_utc or datetime.now(pytz.utc)
+        try:
+            page = await get_new_posts(self.since(now_utc), self.etag,
+                                       self.last_modified, API_POST_FIELDS)
+        except ApiError as error:
+            # Пока API недоступен, рассылка идёт по локальной копии
+            logger.error('Лента постов не обновлена, используется локальная '
+                         'копия: %s', error)
+        else:
+            self.update(page, now_utc)
+        self.expire(now_utc)
+        return PreparedPosts(self.posts.values())
+
+    def update(self, page, now_utc):
+        """Применение ответа API к окну"""
+        if page.not_modified:
+            logger.info('Новых постов нет')
+        else:
+            cutoff = (now_utc - self.window).timestamp()
+            added = [
+                post for post in page.results
+                if isinstance(post, dict)
+                and post.get('id') not in self.posts and self.add(post, cutoff)
+            ]
+            self.etag = page.etag
+            self.last_modified = page.last_modified
+            if added:
+                self.version += 1
+            logger.info('Получено новых постов: %s', describe(added))
+
+
+post_feed = PostFeed()
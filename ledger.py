@@ -0,0 +1,134 @@
+import logging
+import os
+import sqlite3
+import time
+
+from config import LEDGER_PATH, LEDGER_TTL_HOURS
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryLedger:
+    """Журнал доставленных постов.
+
+    Пары (пользователь, пост) хранятся в SQLite и дублируются в памяти,
+    поэтому проверка «уже доставлено?» не обращается к диску.
+    Записи старше ``ttl`` секунд удаляются при очистке.
+    """
+
+    # Минимальная пауза между плановыми очистками в секундах
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, path=LEDGER_PATH, ttl=LEDGER_TTL_HOURS * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._db = None
+        # chat id -> {id поста: время доставки}
+        self.delivered = {}
+        # Время последнего чтения журнала с диска
+        self.loaded_at = None
+        # Время последней очистки по time.monotonic()
+        self.pruned_at = None
+
+    def open(self):
+        """Открытие журнала и загрузка записей в память"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Журнал общий для процессов шардов: запись ждёт освобождения базы
+        self._db = sqlite3.connect(self.path, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS delivered ('
+            'chat_id INTEGER NOT NULL, '
+            'post_id NOT NULL, '
+            'sent_at REAL NOT NULL, '
+            'PRIMARY KEY (chat_id, post_id)) WITHOUT ROWID'
+        )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS delivered_sent_at '
+            'ON delivered (sent_at)'
+        )
+        self.prune()
+        self.delivered = {}
+        self.loaded_at = None
+        self.refresh()
+        logger.info('Загружен журнал доставки: %s, пользователей %s',
+                    self.path, len(self.delivered))
+
+    def close(self):
+        """Закрытие журнала"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def refresh(self, margin=60):
+        """Догрузка записей, сделанных другими процессами.
+
+        Перечитываются записи не старше предыдущего чтения за вычетом
+        ``margin`` секунд, чтобы не пропустить транзакции, которые
+        завершились позже, чем были отмечены.
+        """
+        if self._db is None:
+            return
+        started_at = time.time()
+        since = 0 if self.loaded_at is None else self.loaded_at - margin
+        for chat_id, post_id, sent_at in self._db.execute(
+            'SELECT chat_id, post_id, sent_at FROM delivered '
+            'WHERE sent_at >= ?', (since,)
+        ):
+            self.delivered.setdefault(chat_id, {})[post_id] = sent_at
+        self.loaded_at = started_at
+
+    def is_delivered(self, chat_id, post_id):
+        """Был ли пост уже доставлен пользователю"""
+        return post_id in self.delivered.get(chat_id, ())
+
+    def mark_delivered(self, pairs):
+        """Отметка пар (chat id, id поста) доставленными"""
+        pairs = list(pairs)
+        if not pairs:
+            return
+        sent_at = time.time()
+        for chat_id, post_id in pairs:
+            self.delivered.setdefault(chat_id, {})[post_id] = sent_at
+        if self._db is not None:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO delivered '
+                    '(chat_id, post_id, sent_at) VALUES (?, ?, ?)',
+                    [(chat_id, post_id, sent_at)
+                     for chat_id, post_id in pairs]
+                )
+
+    def prune_due(self, interval=PRUNE_INTERVAL):
+        """Очистка, если с предыдущей прошло не меньше ``interval`` секунд.
+
+        Очистка перебирает весь журнал в памяти, поэтому циклы рассылки
+        вызывают её не чаще раза в ``interval``.
+        """
+        if (self.pruned_at is not None
+                and time.monotonic() - self.pruned_at < interval):
+            return False
+        self.prune()
+        return True
+
+    def prune(self, now=None):
+        """Удаление записей старше срока хранения"""
+        self.pruned_at = time.monotonic()
+        cutoff = (now or time.time()) - self.ttl
+        for chat_id in list(self.delivered):
+            posts = self.delivered[chat_id]
+            for post_id in [post_id for post_id, sent_at in posts.items()
+                            if sent_at < cutoff]:
+                del posts[post_id]
+            if not posts:
+                del self.delivered[chat_id]
+        if self._db is not None:
+            with self._db:
+                self._db.execute('DELETE FROM delivered WHERE sent_at < ?',
+                                 (cutoff,))
+
+
+ledger = DeliveryLedger()
@@ -0,0 +1,89 @@
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+from config import LOG_FILE, LOG_LEVEL, LOG_SAMPLE_EVERY
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener = None
+
+
+def setup_logging(level=LOG_LEVEL, filename=LOG_FILE):
+    """Настройка логирования через очередь.
+
+    Обработчики логгеров только кладут записи в очередь, а форматирование
+    и запись в поток или файл выполняет отдельный поток, поэтому вывод
+    не блокирует цикл событий.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if filename:
+        handlers.append(logging.FileHandler(filename, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level)
+    # Запросы httpx к Bot API не пишутся в журнал по одному
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    _listener = QueueListener(records, *handlers,
+                              respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Запись оставшихся сообщений и остановка потока логирования"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class SamplingFilter(logging.Filter):
+    """Выборочная запись повторяющихся сообщений.
+
+    Сообщения уровня INFO и ниже с одинаковым шаблоном записываются
+    один раз из ``every``; к записанному сообщению добавляется число
+    пропущенных. Предупреждения и ошибки пропускаются всегда.
+    """
+
+    def __init__(self, every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = every
+        # Шаблон сообщения -> число сообщений с момента последней записи
+        self.skipped = {}
+
+    def filter(self, record):
+        if self.every <= 1 or record.levelno > logging.INFO:
+            return True
+        skipped = self.skipped.get(record.msg, 0)
+        if skipped and skipped < self.every:
+            self.skipped[record.msg] = skipped + 1
+            return False
+        self.skipped[record.msg] = 1
+        if skipped and isinstance(record.args, tuple):
+            record.msg = f'{record.msg} (и ещё %s похожих)'
+            record.args = record.args + (skipped - 1,)
+        return True
+
+
+def describe(records, limit=5):
+    """Краткое описание записей API: число и первые id"""
+    ids = [str(record.get('id')) for record in records[:limit]
+           if isinstance(record, dict)]
+    if not ids:
+        return str(len(records))
+    more = ', …' if len(records) > limit else ''
+    return f"{len(records)} (id: {', '.join(ids)}{more})"
@@ -0,0 +1,547 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import AsyncExitStack
+from urllib.parse import urlsplit
+
+import aiohttp
+from telegram.error import BadRequest
+
+from config import (
+    FILE_ID_CACHE_PATH, MEDIA_CACHE_BYTES, MEDIA_CHUNK_SIZE,
+    MEDIA_CONCURRENCY, MEDIA_DIR, MEDIA_REVALIDATE_INTERVAL, MEDIA_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CachedMedia:
+    """Запись кэша медиафайлов для адреса"""
+
+    __slots__ = ('url', 'path', 'digest', 'size', 'etag', 'last_modified',
+                 'validated_at')
+
+    def __init__(self, url, path, digest, size, etag=None,
+                 last_modified=None, validated_at=0.0):
+        self.url = url
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated_at = validated_at
+
+    def validators(self):
+        """Заголовки условного запроса для проверки изменений файла"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class MediaCache:
+    """Постоянный кэш загруженных медиафайлов на диске.
+
+    Файлы хранятся под именем из хеша SHA-256 содержимого, поэтому
+    одинаковые файлы с разных адресов занимают место один раз, а файлы
+    с одинаковыми именами с разных адресов не затирают друг друга.
+    Индекс адресов и файлов хранится в SQLite в том же каталоге.
+    Когда объём файлов превышает ``budget`` байт, удаляются давно
+    не использованные файлы. Файлы, использованные за последние ``hold``
+    секунд, не удаляются: их пути уже могли быть переданы на отправку.
+    """
+
+    INDEX_NAME = 'index.sqlite3'
+
+    def __init__(self, directory=MEDIA_DIR, budget=MEDIA_CACHE_BYTES,
+                 hold=MEDIA_TIMEOUT):
+        self.directory = directory
+        self.budget = budget
+        self.hold = hold
+        self._db = None
+        # Адрес -> запись кэша
+        self.entries = {}
+        # Хеш содержимого -> размер файла в байтах
+        self.sizes = {}
+        # Хеш содержимого -> путь к файлу
+        self.paths = {}
+
+    @property
+    def total(self):
+        """Объём файлов кэша в байтах"""
+        return sum(self.sizes.values())
+
+    def open(self):
+        """Открытие индекса кэша и загрузка записей в память"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.directory,
+                                                self.INDEX_NAME))
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'digest TEXT PRIMARY KEY, '
+            'path TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'used_at REAL NOT NULL) WITHOUT ROWID'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS urls ('
+            'url TEXT PRIMARY KEY, '
+            'digest TEXT NOT NULL, '
+            'etag TEXT, '
+            'last_modified TEXT, '
+            'validated_at REAL NOT NULL) WITHOUT ROWID'
+        )
+        self.entries = {}
+        self.sizes = {}
+        self.paths = {}
+        missing = []
+        for digest, path, size in self._db.execute(
+            'SELECT digest, path, size FROM files'
+        ):
+            if os.path.exists(path):
+                self.paths[digest] = path
+                self.sizes[digest] = size
+            else:
+                missing.append(digest)
+        for url, digest, etag, last_modified, validated_at in self._db.execute(
+            'SELECT url, digest, etag, last_modified, validated_at FROM urls'
+        ):
+            if digest in self.paths:
+                self.entries[url] = CachedMedia(
+                    url, self.paths[digest], digest, self.sizes[digest], etag,
+                    last_modified, validated_at
+                )
+        if missing:
+            # Файлы удалены с диска в обход кэша
+            self._forget(missing)
+        self._remove_partial()
+        logger.info('Загружен кэш медиафайлов: %s файлов, %s байт',
+                    len(self.sizes), self.total)
+        self.evict()
+
+    def close(self):
+        """Закрытие индекса кэша"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remove_partial(self):
+        """Удаление недописанных файлов прерванных загрузок"""
+        for name in os.listdir(self.directory):
+            if name.endswith('.part'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as error:
+                    logger.error('Ошибка при удалении файла %s: %s',
+                                 name, error)
+
+    def temp_path(self):
+        """Путь для записи загружаемого файла в каталоге кэша"""
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f'{uuid.uuid4().hex}.part')
+
+    def path_for(self, url, digest):
+        """Путь к файлу по хешу содержимого с расширением из адреса"""
+        extension = os.path.splitext(urlsplit(url).path)[1][:16]
+        return os.path.join(self.directory, digest[:2], digest + extension)
+
+    def get(self, url):
+        """Запись кэша для адреса или None"""
+        entry = self.entries.get(url)
+        if entry is not None and not os.path.exists(entry.path):
+            self._forget([entry.digest])
+            return None
+        return entry
+
+    def is_fresh(self, entry, interval=MEDIA_REVALIDATE_INTERVAL):
+        """Проверялся ли файл на сервере не дольше ``interval`` секунд назад"""
+        return time.time() - entry.validated_at < interval
+
+    def touch(self, entry, validated=False):
+        """Отметка об использовании файла и, если нужно, о его проверке"""
+        now = time.time()
+        if validated:
+            entry.validated_at = now
+        if self._db is None:
+            return
+        with self._db:
+            self._db.execute('UPDATE files SET used_at = ? WHERE digest = ?',
+                             (now, entry.digest))
+            if validated:
+                self._db.execute(
+                    'UPDATE urls SET validated_at = ? WHERE url = ?',
+                    (now, entry.url)
+                )
+
+    def store(self, url, temp_path, digest, size, etag=None,
+              last_modified=None):
+        """Перенос загруженного файла в кэш; возвращает запись кэша.
+
+        Файл появляется под итоговым именем атомарно через ``os.replace``.
+        Если файл с тем же содержимым уже есть, в том числе под именем
+        с другим расширением, загруженная копия удаляется и адрес
+        ссылается на имеющийся файл.
+        """
+        path = self.paths.get(digest)
+        if path is not None and os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            path = self.path_for(url, digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        now = time.time()
+        self.sizes[digest] = size
+        self.paths[digest] = path
+        entry = CachedMedia(url, path, digest, size, etag, last_modified, now)
+        self.entries[url] = entry
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO files (digest, path, size, '
+                    'used_at) VALUES (?, ?, ?, ?)', (digest, path, size, now)
+                )
+                self._db.execute(
+                    'INSERT OR REPLACE INTO urls (url, digest, etag, '
+                    'last_modified, validated_at) VALUES (?, ?, ?, ?, ?)',
+                    (url, digest, etag, last_modified, now)
+                )
+        self.evict(keep=digest)
+        return entry
+
+    def evict(self, keep=None):
+        """Удаление давно не использованных файлов сверх ``budget``"""
+        total = self.total
+        if total <= self.budget or self._db is None:
+            return
+        evicted = []
+        for digest, path, size in self._db.execute(
+            'SELECT digest, path, size FROM files WHERE used_at < ? '
+            'ORDER BY used_at', (time.time() - self.hold,)
+        ).fetchall():
+            if total <= self.budget:
+                break
+            if digest == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                logger.error('Ошибка при удалении файла кэша %s: %s',
+                             path, error)
+                continue
+            total -= size
+            evicted.append(digest)
+        self._forget(evicted)
+        if evicted:
+            logger.info('Из кэша медиафайлов удалено %s файлов, занято '
+                        '%s байт', len(evicted), total)
+        if total > self.budget:
+            logger.warning('Кэш медиафайлов занимает %s байт при пределе %s: '
+                           'остальные файлы используются', total, self.budget)
+
+    def _forget(self, digests):
+        """Удаление записей о файлах и ссылающихся на них адресах"""
+        digests = set(digests)
+        if not digests:
+            return
+        for digest in digests:
+            self.sizes.pop(digest, None)
+            self.paths.pop(digest, None)
+        for url in [url for url, entry in self.entries.items()
+                    if entry.digest in digests]:
+            del self.entries[url]
+        if self._db is not None:
+            with self._db:
+                self._db.executemany('DELETE FROM files WHERE digest = ?',
+                                     [(digest,) for digest in digests])
+                self._db.executemany('DELETE FROM urls WHERE digest = ?',
+                                     [(digest,) for digest in digests])
+
+
+class MediaFetcher:
+    """Асинхронная загрузка медиафайлов постов.
+
+    Тело ответа пишется на диск частями, число одновременных загрузок
+    ограничено, а параллельные запросы одного адреса объединяются
+    в одну загрузку. Загруженные файлы хранятся в кэше ``cache``
+    и перед повторным использованием проверяются условным запросом.
+    """
+
+    def __init__(self, cache, concurrency=MEDIA_CONCURRENCY,
+                 chunk_size=MEDIA_CHUNK_SIZE, timeout=MEDIA_TIMEOUT,
+                 revalidate=MEDIA_REVALIDATE_INTERVAL):
+        self.cache = cache
+        self.revalidate = revalidate
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._session = None
+        # Ключ -> задача, выполняющаяся в данный момент
+        self._inflight = {}
+
+    @property
+    def session(self):
+        """Сессия загрузки; открывается при первом обращении"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def close(self):
+        """Закрытие сессии загрузки"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _single_flight(self, key, factory):
+        """Одна выполняющаяся задача на ключ для всех ожидающих"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отмена одного ожидающего не прерывает общую загрузку
+        return await asyncio.shield(task)
+
+    async def check(self, url):
+        """Проверка доступности файла без загрузки тела"""
+        return await self._single_flight(('check', url),
+                                         lambda: self._check(url))
+
+    async def _check(self, url):
+        session = self.session
+        async with self._semaphore:
+            async with session.head(url, allow_redirects=True) as response:
+                if response.status not in (405, 501):
+                    return response.status < 400
+            # Сервер не поддерживает HEAD: читаются только заголовки
+            async with session.get(url) as response:
+                return response.status < 400
+
+    async def fetch(self, url):
+        """Загрузка файла через кэш; возвращает запись кэша"""
+        return await self._single_flight(('download', url),
+                                         lambda: self._download(url))
+
+    async def _download(self, url):
+        entry = self.cache.get(url)
+        if entry is not None and self.cache.is_fresh(entry, self.revalidate):
+            self.cache.touch(entry)
+            return entry
+        headers = entry.validators() if entry is not None else {}
+        temp_path = self.cache.temp_path()
+        session = self.session
+        try:
+            async with self._semaphore:
+                async with session.get(url, headers=headers) as response:
+                    if response.status == 304 and entry is not None:
+                        # Файл не изменился: используется копия на диске
+                        self.cache.touch(entry, validated=True)
+                        logger.info('Файл %s не изменился, взят из кэша',
+                                    url)
+                        return entry
+                    response.raise_for_status()
+                    digest = hashlib.sha256()
+                    size = 0
+                    with open(temp_path, 'wb') as media_file:
+                        async for chunk in response.content.iter_chunked(
+                            self.chunk_size
+                        ):
+                            digest.update(chunk)
+                            size += len(chunk)
+                            media_file.write(chunk)
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+            stored = self.cache.store(url, temp_path, digest.hexdigest(),
+                                      size, etag, last_modified)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if entry is None:
+                raise
+            # Источник недоступен: используется последняя проверенная копия
+            logger.warning('Не удалось проверить файл %s, взят из кэша: %s',
+                           url, error)
+            self.cache.touch(entry)
+            return entry
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logger.info('Файл %s загружен в %s', url, stored.path)
+        return stored
+
+
+def message_file_id(message, kind):
+    """file_id медиафайла из отправленного сообщения"""
+    if kind == 'photo' and message.photo:
+        # Самый крупный из размеров фотографии
+        return message.photo[-1].file_id
+    if kind == 'video' and message.video:
+        return message.video.file_id
+    return None
+
+
+class FileIdCache:
+    """Кэш file_id Telegram для медиафайлов.
+
+    После первой успешной отправки файла его file_id сохраняется
+    в SQLite, и остальные получатели получают файл по file_id без
+    повторной загрузки в Telegram.
+    """
+
+    def __init__(self, path=FILE_ID_CACHE_PATH):
+        self.path = path
+        self._db = None
+        # (тип, источник) -> file_id; источник видео — хеш содержимого
+        self.file_ids = {}
+        # (тип, источник) -> [блокировка, число ожидающих]
+        self._locks = {}
+
+    def open(self):
+        """Открытие кэша и загрузка записей в память"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS file_ids ('
+            'kind TEXT NOT NULL, '
+            'source TEXT NOT NULL, '
+            'file_id TEXT NOT NULL, '
+            'updated_at REAL NOT NULL, '
+            'PRIMARY KEY (kind, source)) WITHOUT ROWID'
+        )
+        self.file_ids = {
+            (kind, source): file_id for kind, source, file_id
+            in self._db.execute('SELECT kind, source, file_id FROM file_ids')
+        }
+        logger.info('Загружен кэш file_id: %s файлов', len(self.file_ids))
+
+    def close(self):
+        """Закрытие кэша"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, kind, source):
+        return self.file_ids.get((kind, source))
+
+    def set(self, kind, source, file_id):
+        self.file_ids[(kind, source)] = file_id
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO file_ids '
+                    '(kind, source, file_id, updated_at) VALUES (?, ?, ?, ?)',
+                    (kind, source, file_id, time.time())
+                )
+
+    def forget(self, kind, source):
+        self.file_ids.pop((kind, source), None)
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    'DELETE FROM file_ids WHERE kind = ? AND source = ?',
+                    (kind, source)
+                )
+
+    async def _acquire(self, key):
+        """Блокировка первой загрузки файла с ключом ``key``"""
+        # Блокировка удаляется, когда её больше никто не ждёт
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._unref(key)
+            raise
+
+    def _release(self, key):
+        self._locks[key][0].release()
+        self._unref(key)
+
+    def _unref(self, key):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[key]
+
+    async def _resolve(self, items, keys, upload):
+        """Данные для отправки: file_id, если он известен, иначе файл"""
+        resolved = []
+        for (kind, source), key in zip(items, keys):
+            file_id = self.file_ids.get(key)
+            if file_id is not None:
+                resolved.append((kind, key, file_id, True))
+                continue
+            media = await upload(kind, source)
+            if media is not None:
+                resolved.append((kind, key, media, False))
+        return resolved
+
+    async def send_group(self, items, send, upload, keys=None):
+        """Отправка медиафайлов по file_id, а при его отсутствии — загрузкой.
+
+        ``items`` — список пар (тип, источник). ``upload(тип, источник)``
+        возвращает исходные данные файла (адрес или путь) либо None, если
+        файл недоступен. ``send`` получает список пар (тип, данные) и
+        возвращает отправленные сообщения в том же порядке.
+        ``keys`` — ключи file_id для файлов в том же порядке, по умолчанию
+        сами пары (тип, источник).
+        Пока файл загружается впервые, остальные получатели ждут его
+        file_id, а не загружают файл повторно.
+        """
+        keys = list(keys) if keys is not None else list(items)
+        missing = sorted({key for key in keys if key not in self.file_ids})
+        async with AsyncExitStack() as stack:
+            for key in missing:
+                await self._acquire(key)
+                if key in self.file_ids:
+                    # file_id получен, пока шло ожидание: блокировка
+                    # нужна только загружающему файл впервые
+                    self._release(key)
+                else:
+                    stack.callback(self._release, key)
+            resolved = await self._resolve(items, keys, upload)
+            if not resolved:
+                return []
+            try:
+                messages = await send([(kind, media) for kind, _, media, _
+                                       in resolved])
+            except BadRequest as error:
+                cached = [key for _, key, _, is_cached in resolved
+                          if is_cached]
+                if not cached or 'file' not in str(error).lower():
+                    raise
+                # file_id стал недействительным: файлы загружаются заново
+                logger.warning('Недействительный file_id для %s: %s',
+                               cached, error)
+                for kind, source in cached:
+                    self.forget(kind, source)
+                resolved = await self._resolve(items, keys, upload)
+                messages = await send([(kind, media) for kind, _, media, _
+                                       in resolved])
+            for (kind, key, _, is_cached), message in zip(resolved,
+                                                          messages):
+                file_id = message_file_id(message, kind)
+                if not is_cached and file_id:
+                    self.set(*key, file_id)
+            return messages
+
+
+media_cache = MediaCache()
+media_fetcher = MediaFetcher(media_cache)
+file_id_cache = FileIdCache()
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+
+from aiohttp import TraceConfig, web
+from prometheus_client import (
+    REGISTRY, Counter, Gauge, Histogram, disable_created_metrics
+)
+from prometheus_client.exposition import choose_encoder
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Ряды *_created со временем создания счётчиков не нужны
+disable_created_metrics()
+
+
+# Метрики бота
+jetadmin_latency = Histogram(
+    'jetadmin_request_duration_seconds',
+    'Длительность запросов к JetAdmin API', ('method', 'table')
+)
+jetadmin_requests = Counter(
+    'jetadmin_requests', 'Запросы к JetAdmin API по коду ответа',
+    ('method', 'table', 'status')
+)
+telegram_latency = Histogram(
+    'telegram_request_duration_seconds',
+    'Длительность запросов к Telegram Bot API', ('method',)
+)
+telegram_requests = Counter(
+    'telegram_requests', 'Запросы к Telegram Bot API по коду ответа',
+    ('method', 'status')
+)
+posts_delivered = Counter('broadcast_posts_delivered',
+                          'Доставленные пользователям посты')
+posts_failed = Counter('broadcast_posts_failed',
+                       'Посты, которые не удалось доставить')
+users_blocked = Counter('broadcast_users_blocked',
+                        'Пользователи, заблокировавшие бота')
+tick_duration = Gauge('broadcast_tick_duration_seconds',
+                      'Длительность последнего тика рассылки')
+tick_lag = Gauge('broadcast_tick_lag_seconds',
+                 'Отставание рассылки от самого раннего незавершённого тика')
+ticks_merged = Counter('broadcast_ticks_merged',
+                       'Тики, работа которых передана выполняющемуся тику')
+ticks_skipped = Counter('broadcast_ticks_skipped',
+                        'Тики, пропущенные из-за незавершённого плана')
+eligible_users = Gauge('broadcast_eligible_users',
+                       'Пользователи с открытым окном в последнем тике')
+send_queue_depth = Gauge('send_queue_depth',
+                         'Сообщения в очереди планировщика отправки')
+write_queue_depth = Gauge('write_queue_depth',
+                          'Пользователи в очереди отложенной записи')
+broadcast_queue_depth = Gauge('broadcast_queue_depth',
+                              'Задания в очереди рассылки')
+
+
+def client_trace(table_of):
+    """Трассировка aiohttp-сессии JetAdmin API.
+
+    ``table_of(url)`` возвращает имя таблицы для метки запроса.
+    """
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        observe(params.method, params.url, params.response.status,
+                context.started)
+
+    async def on_request_exception(session, context, params):
+        observe(params.method, params.url, 'error', context.started)
+
+    def observe(method, url, status, started):
+        table = table_of(str(url))
+        jetadmin_latency.labels(method, table).observe(
+            time.perf_counter() - started
+        )
+        jetadmin_requests.labels(method, table, status).inc()
+
+    trace = TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    return trace
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером длительности запросов по методам Bot API.
+
+    ``before_send`` вызывается перед каждым запросом методов send*,
+    например для учёта сообщения в общем лимите частоты отправки.
+    """
+
+    before_send = None
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        if self.before_send is not None and api_method.startswith('send'):
+            self.before_send()
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            status, payload = await super().do_request(url, method,
+                                                       *args, **kwargs)
+            return status, payload
+        finally:
+            telegram_latency.labels(api_method).observe(
+                time.perf_counter() - started
+            )
+            telegram_requests.labels(api_method, status).inc()
+
+
+class MetricsServer:
+    """HTTP-сервер метрик в формате Prometheus"""
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self._runner = None
+
+    async def handle(self, request):
+        # Формат выдачи выбирается по заголовку Accept сборщика
+        encoder, content_type = choose_encoder(request.headers.get('Accept'))
+        # Сбор идёт в потоке: функции метрик могут ждать базу очереди
+        body = await asyncio.to_thread(encoder, self.registry)
+        return web.Response(body=body,
+                            headers={'Content-Type': content_type})
+
+    async def start(self, host, port):
+        """Запуск сервера; порт 0 отключает метрики.
+
+        Если порт занят, ошибка записывается в журнал, а бот работает
+        без метрик.
+        """
+        if not port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, host, port).start()
+        except OSError as error:
+            logger.error('Не удалось запустить сервер метрик на %s:%s: %s',
+                         host, port, error)
+            await self.stop()
+            return
+        logger.info('Метрики доступны на http://%s:%s/metrics', host, port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
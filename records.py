@@ -0,0 +1,144 @@
+import sys
+from datetime import datetime
+from functools import lru_cache
+
+import pytz
+
+from albums import compile_post, post_text
+
+MINUTES_IN_DAY = 24 * 60
+
+# Формат поля date_create в ответах API
+POST_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def parse_post_date(value):
+    """Разбор даты создания поста в UTC"""
+    return datetime.strptime(value, POST_DATE_FORMAT).replace(tzinfo=pytz.utc)
+
+
+def offset_minutes(time_zone):
+    """Смещение часового пояса ±чч:мм в минутах"""
+    sign = time_zone[0]
+    hours, minutes = map(int, time_zone[1:].split(':'))
+    offset = hours * 60 + minutes
+    if sign == '-':
+        offset = -offset
+    elif sign != '+':
+        raise ValueError(f'Неверный формат часового пояса: {time_zone}')
+    return offset
+
+
+def day_minute(value):
+    """Минута суток для времени в формате чч:мм[:сс]"""
+    hours, minutes = map(int, value[:5].split(':'))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f'Неверное время: {value}')
+    return hours * 60 + minutes
+
+
+@lru_cache(maxsize=None)
+def utc_intervals(start, end, offset):
+    """Окно рассылки в виде интервалов минут суток по UTC.
+
+    ``start`` и ``end`` — минуты местных суток, ``offset`` — смещение
+    часового пояса в минутах. Границы включительные. Окно, переходящее
+    через полночь UTC, разбивается на два интервала. Различных окон
+    немного, поэтому результат общий для всех пользователей с тем же окном.
+    """
+    start = (start - offset) % MINUTES_IN_DAY
+    end = (end - offset) % MINUTES_IN_DAY
+    if start <= end:
+        return ((start, end),)
+    return ((start, MINUTES_IN_DAY - 1), (0, end))
+
+
+# Строк настроек времени немного, а пользователей много: разобранные
+# значения запоминаются по исходной строке
+parse_offset = lru_cache(maxsize=1024)(offset_minutes)
+parse_minute = lru_cache(maxsize=4096)(day_minute)
+
+
+def intern(value):
+    """Общий экземпляр строки настроек для всех пользователей"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class UserRecord:
+    """Пользователь зеркала с разобранным окном рассылки.
+
+    Запись строится один раз при загрузке или изменении пользователя:
+    смещение часового пояса и границы окна хранятся в минутах, а
+    интервалы UTC и строки настроек разделяются между пользователями
+    с одинаковыми настройками. Поля API, которые боту не нужны,
+    не хранятся.
+    """
+
+    __slots__ = ('chat_id', 'name', 'active', 'start_time', 'end_time',
+                 'time_zone', 'offset', 'start_minute', 'end_minute',
+                 'intervals')
+
+    # Поля API, переносимые в запись
+    FIELDS = ('name', 'active', 'start_time', 'end_time', 'time_zone')
+
+    def __init__(self, chat_id, name=None, active=None, start_time=None,
+                 end_time=None, time_zone=None):
+        self.chat_id = chat_id
+        self.name = name
+        self.active = active
+        self.start_time = intern(start_time)
+        self.end_time = intern(end_time)
+        self.time_zone = intern(time_zone)
+        try:
+            self.offset = parse_offset(time_zone)
+            self.start_minute = parse_minute(start_time)
+            self.end_minute = parse_minute(end_time)
+        except (AttributeError, IndexError, TypeError, ValueError):
+            # Некорректные настройки: пользователь не попадает в индекс окон
+            self.offset = self.start_minute = self.end_minute = None
+            self.intervals = None
+        else:
+            self.intervals = utc_intervals(self.start_minute,
+                                           self.end_minute, self.offset)
+
+    def __repr__(self):
+        return (f'UserRecord({self.chat_id!r}, active={self.active!r}, '
+                f'window={self.start_time}-{self.end_time} '
+                f'{self.time_zone})')
+
+    @classmethod
+    def merge(cls, chat_id, data, previous=None):
+        """Запись из данных API поверх предыдущей записи пользователя"""
+        return cls(chat_id, *(
+            data[field] if field in data else getattr(previous, field, None)
+            for field in cls.FIELDS
+        ))
+
+    def is_open(self, minute):
+        """Открыто ли окно рассылки в минуту суток UTC"""
+        return bool(self.active and self.intervals) and any(
+            start <= minute <= end for start, end in self.intervals
+        )
+
+
+class PostRecord:
+    """Пост ленты, подготовленный к рассылке.
+
+    Дата создания разобрана в метку времени UTC, текст отрисован,
+    а пост разбит на отправки один раз при получении. Исходные данные
+    API хранятся для передачи исполнителям шардов.
+    """
+
+    __slots__ = ('id', 'timestamp', 'date_create', 'text', 'parts',
+                 'payload')
+
+    def __init__(self, payload):
+        self.id = payload['id']
+        self.date_create = payload['date_create']
+        self.timestamp = parse_post_date(self.date_create).timestamp()
+        self.text = post_text(payload)
+        self.parts = compile_post(payload, self.text)
+        self.payload = payload
+
+    def __repr__(self):
+        return f'PostRecord({self.id!r}, date_create={self.date_create!r})'
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонён: автомат защиты разомкнут"""
+
+
+class CircuitBreaker:
+    """Автомат защиты от обращений к неработающему сервису.
+
+    После ``failure_threshold`` сбоев подряд автомат размыкается и
+    вызовы сразу завершаются ошибкой. Через ``reset_timeout`` секунд
+    пропускается пробный вызов: успех замыкает автомат, сбой снова
+    размыкает его.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def check(self):
+        """Разрешение вызова; CircuitOpenError, если автомат разомкнут.
+
+        Возвращает True, если разрешён пробный вызов: только он должен
+        вызывать ``release()``.
+        """
+        if self.opened_at is None:
+            return False
+        if (not self._trial
+                and time.monotonic() - self.opened_at >= self.reset_timeout):
+            # Пробный вызов после паузы
+            self._trial = True
+            return True
+        raise CircuitOpenError(f'Сервис {self.name} временно недоступен')
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info('Сервис %s снова доступен', self.name)
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def release(self):
+        """Снятие отметки пробного вызова, завершённого без результата.
+
+        Вызывается только для вызова, которому ``check()`` вернул True.
+        """
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._trial:
+                logger.error('Сервис %s недоступен, запросы приостановлены на '
+                             '%s с', self.name, self.reset_timeout)
+            self.opened_at = time.monotonic()
+            self._trial = False
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Пауза перед повтором: экспоненциальная со случайным разбросом"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+async def retry(factory, attempts, base_delay, max_delay, retry_on):
+    """Вызов ``factory()`` с повторами при ошибках из ``retry_on``"""
+    for attempt in range(attempts):
+        try:
+            return await factory()
+        except retry_on as error:
+            if attempt + 1 >= attempts:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            logger.warning('Повтор запроса через %.2f с: %s', delay, error)
+            await asyncio.sleep(delay)
+
+
+async def hedged(factory, delay):
+    """Дублирующий запрос, если первый не завершился за ``delay`` секунд.
+
+    Возвращается первый успешный результат, оставшийся запрос
+    отменяется. Ошибка возвращается, только если упали оба запроса.
+    """
+    tasks = {asyncio.ensure_future(factory())}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.add(asyncio.ensure_future(factory()))
+        pending = tasks
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
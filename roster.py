@@ -0,0 +1,172 @@
+import logging
+import time
+
+from api import get_user, iter_users
+from records import UserRecord
+from writer import write_behind
+from config import (
+    API_USER_ACTIVE_PARAM, API_USER_FIELDS, API_USER_UPDATED_SINCE_PARAM,
+    ROSTER_RELOAD_INTERVAL, USER_UPDATED_FIELD
+)
+
+logger = logging.getLogger(__name__)
+
+# Поля пользователя, запрашиваемые у API: без поля обновления
+# догрузку изменений построить нельзя
+USER_FIELDS = list(dict.fromkeys(['id', *API_USER_FIELDS,
+                                  USER_UPDATED_FIELD]))
+
+
+def user_key(chat_id):
+    """Ключ пользователя в зеркале"""
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return chat_id
+
+
+class Roster:
+    """Локальное зеркало таблицы пользователей.
+
+    Загружается один раз при запуске, затем догружает изменения по полю
+    времени обновления. Собственные изменения бота сразу применяются
+    к зеркалу и записываются в API отложенно. Пользователи хранятся
+    в виде ``UserRecord``.
+    """
+
+    def __init__(self):
+        # chat id -> запись пользователя
+        self.users = {}
+        # Самое позднее значение поля обновления среди записей,
+        # полученных загрузкой или догрузкой таблицы
+        self.synced_at = None
+        # Полная загрузка завершилась без ошибок
+        self.complete = False
+        # Время окончания последней полной загрузки (time.monotonic)
+        self.loaded_at = None
+        self._listeners = []
+
+    def __len__(self):
+        return len(self.users)
+
+    def values(self):
+        return self.users.values()
+
+    def get(self, chat_id):
+        return self.users.get(user_key(chat_id))
+
+    def subscribe(self, callback):
+        """Подписка на изменения: callback(старая запись, новая запись)"""
+        self._listeners.append(callback)
+
+    def apply(self, user):
+        """Применение данных пользователя из API к зеркалу.
+
+        Курсор догрузки не сдвигается: записи одного пользователя,
+        полученные вне ``load``/``sync``, не означают, что изменения
+        остальных пользователей уже получены.
+        """
+        if not isinstance(user, dict) or 'id' not in user:
+            return None
+        key = user_key(user['id'])
+        previous = self.users.get(key)
+        current = UserRecord.merge(key, user, previous)
+        self.users[key] = current
+        for callback in self._listeners:
+            callback(previous, current)
+        return current
+
+    def _advance(self, user):
+        """Сдвиг курсора догрузки по записи, полученной из таблицы"""
+        updated_at = user.get(USER_UPDATED_FIELD)
+        if updated_at and (self.synced_at is None
+                           or updated_at > self.synced_at):
+            self.synced_at = updated_at
+
+    async def load(self):
+        """Полная загрузка активных пользователей.
+
+        Неактивные пользователи рассылку не получают и в зеркало
+        не загружаются: при обращении к ним данные запрашиваются у API.
+        Пользователи зеркала, которых нет в выборке активных, отмечаются
+        неактивными. При сбое API уже загруженные записи остаются
+        в зеркале, а ``ApiError`` передаётся вызывающему.
+        """
+        count = 0
+        seen = set()
+        filters = ({API_USER_ACTIVE_PARAM: True} if API_USER_ACTIVE_PARAM
+                   else None)
+        async for user in iter_users(filters=filters, fields=USER_FIELDS):
+            current = self.apply(user)
+            if current is not None:
+                self._advance(user)
+                count += 1
+                seen.add(current.chat_id)
+        if filters:
+            # Изменения бота, ещё не записанные в API, не отменяются
+            stale = [key for key, user in self.users.items()
+                     if user.active and key not in seen
+                     and key not in write_behind.pending]
+            for key in stale:
+                self.apply({'id': key, 'active': False})
+        self.complete = True
+        self.loaded_at = time.monotonic()
+        logger.info('Загружено пользователей в зеркало: %s', count)
+        return count
+
+    async def sync(self, reload_interval=ROSTER_RELOAD_INTERVAL):
+        """Догрузка пользователей, изменённых после последней синхронизации.
+
+        Если у записей нет поля обновления, дельту построить нельзя:
+        зеркало полностью перезагружается не чаще раза в
+        ``reload_interval`` секунд.
+        """
+        if not self.complete:
+            # Прерванная загрузка повторяется целиком
+            return await self.load()
+        if self.synced_at is None:
+            if time.monotonic() - self.loaded_at < reload_interval:
+                return 0
+            logger.warning('В записях пользователей нет поля %s: зеркало '
+                           'перезагружается целиком', USER_UPDATED_FIELD)
+            return await self.load()
+        count = 0
+        params = {API_USER_UPDATED_SINCE_PARAM: self.synced_at}
+        # Без фильтра активности: догрузка должна увидеть отключения
+        async for user in iter_users(params=params, fields=USER_FIELDS):
+            if self.apply(user) is not None:
+                self._advance(user)
+                count += 1
+        logger.info('Синхронизировано пользователей: %s', count)
+        return count
+
+    async def fetch(self, chat_id):
+        """Запись пользователя из зеркала, при промахе — из API.
+
+        Запись нового пользователя без настроек рассылки тоже
+        запрашивается у API: настройки по умолчанию назначает API при
+        создании. Возвращает None, если пользователя нет и в API.
+        """
+        user = self.get(chat_id)
+        if user is None or user.start_time is None:
+            stored = self.apply(await get_user(chat_id, fields=USER_FIELDS))
+            if stored is not None:
+                user = stored
+        return user
+
+    async def update(self, chat_id, data):
+        """Обновление пользователя.
+
+        Изменение сразу применяется к зеркалу, а в API уходит через
+        очередь отложенной записи.
+        """
+        write_behind.update(user_key(chat_id), data)
+        return self.apply(dict(data, id=chat_id))
+
+    async def store(self, chat_id, name):
+        """Сохранение нового пользователя через очередь отложенной записи"""
+        write_behind.create(user_key(chat_id), {'name': name})
+        return self.apply({'id': chat_id, 'name': name})
+
+
+roster = Roster()
@@ -0,0 +1,282 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from metrics import InstrumentedRequest
+from config import (
+    SEND_CHAT_INTERVAL, SEND_MAX_RETRIES, SEND_QUEUE_SIZE, SEND_RATE,
+    SEND_WORKERS, TELEGRAM_BROADCAST_POOL, TELEGRAM_HTTP_VERSION,
+    TELEGRAM_INTERACTIVE_POOL, TELEGRAM_UPDATES_POOL
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов по алгоритму маркерной корзины"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = None
+        # Создаётся в работающем цикле событий: в Python 3.9 блокировка
+        # привязывается к циклу при создании
+        self._lock = None
+
+    def _refill(self, now):
+        if self.updated_at is not None:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated_at)
+                              * self.rate)
+        self.updated_at = now
+
+    def take(self):
+        """Маркер без ожидания.
+
+        Недостача покрывается следующими маркерами, поэтому ожидающие
+        в ``acquire`` пропускают вперёд взявшего маркер таким образом.
+        """
+        self._refill(asyncio.get_running_loop().time())
+        self.tokens = max(self.tokens - 1, -self.capacity)
+
+    async def acquire(self):
+        """Ожидание свободного маркера"""
+        loop = asyncio.get_running_loop()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                self._refill(loop.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendJob:
+    """Отправка в очереди планировщика"""
+
+    __slots__ = ('factory', 'future', 'attempts')
+
+    def __init__(self, factory, future):
+        self.factory = factory
+        self.future = future
+        self.attempts = 0
+
+
+def retry_after_seconds(error):
+    """Пауза из RetryAfter в секундах"""
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class SendScheduler:
+    """Планировщик отправки сообщений в Telegram.
+
+    Общая частота ограничена маркерной корзиной (``rate`` сообщений
+    в секунду), для каждого чата соблюдается пауза ``chat_interval``
+    между сообщениями. Отправки одного чата выполняются по порядку,
+    при RetryAfter чат откладывается на указанное Telegram время.
+    """
+
+    def __init__(self, rate=SEND_RATE, chat_interval=SEND_CHAT_INTERVAL,
+                 workers=SEND_WORKERS, max_retries=SEND_MAX_RETRIES,
+                 queue_size=SEND_QUEUE_SIZE):
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self.max_retries = max_retries
+        self.queue_size = queue_size
+        # chat id -> очередь отправок чата
+        self._chats = {}
+        # Куча (время готовности, порядковый номер, chat id)
+        self._ready = []
+        self._counter = itertools.count()
+        # Чаты в куче или в работе у исполнителя
+        self._scheduled = set()
+        # chat id -> время последней отправки
+        self._last_sent = {}
+        self._pending = 0
+        self._wakeup = None
+        self._space = None
+        self._tasks = []
+
+    @property
+    def pending(self):
+        """Число отправок в очереди"""
+        return self._pending
+
+    def start(self):
+        """Запуск исполнителей"""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker())
+                       for _ in range(self.workers)]
+        logger.info('Запущен планировщик отправки: %s исполнителей, %s '
+                    'сообщений/с', self.workers, self.bucket.rate)
+
+    async def stop(self):
+        """Остановка исполнителей с отменой неотправленных сообщений"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for jobs in self._chats.values():
+            for job in jobs:
+                if not job.future.done():
+                    job.future.cancel()
+        self._chats.clear()
+        self._ready.clear()
+        self._scheduled.clear()
+        self._pending = 0
+
+    def _schedule(self, chat_id, ready_at):
+        heapq.heappush(self._ready,
+                       (ready_at, next(self._counter), chat_id))
+        self._scheduled.add(chat_id)
+        self._wakeup.set()
+
+    async def submit(self, chat_id, factory):
+        """Постановка отправки в очередь; возвращает future с результатом.
+
+        ``factory`` создаёт корутину отправки и вызывается заново
+        при каждой попытке.
+        """
+        if not self._tasks:
+            self.start()
+        async with self._space:
+            await self._space.wait_for(
+                lambda: self._pending < self.queue_size
+            )
+            self._pending += 1
+        loop = asyncio.get_running_loop()
+        job = SendJob(factory, loop.create_future())
+        self._chats.setdefault(chat_id, deque()).append(job)
+        if chat_id not in self._scheduled:
+            last_sent = self._last_sent.get(chat_id)
+            ready_at = loop.time()
+            if last_sent is not None:
+                ready_at = max(ready_at, last_sent + self.chat_interval)
+            self._schedule(chat_id, ready_at)
+        return job.future
+
+    def reserve(self):
+        """Учёт сообщения, отправленного мимо очереди.
+
+        Ответы пользователям отправляются сразу, а отправки из очереди
+        уступают им место в общем лимите частоты.
+        """
+        self.bucket.take()
+
+    async def send(self, method, **kwargs):
+        """Вызов метода бота через очередь с ожиданием результата"""
+        future = await self.submit(kwargs['chat_id'],
+                                   lambda: method(**kwargs))
+        return await future
+
+    async def _next_chat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            timeout = None
+            if self._ready:
+                ready_at, _, chat_id = self._ready[0]
+                timeout = ready_at - loop.time()
+                if timeout <= 0:
+                    heapq.heappop(self._ready)
+                    return chat_id
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _release(self):
+        async with self._space:
+            self._pending -= 1
+            self._space.notify()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._next_chat()
+            jobs = self._chats[chat_id]
+            job = jobs.popleft()
+            delay = self.chat_interval
+            done = True
+            try:
+                await self.bucket.acquire()
+                job.attempts += 1
+                result = await job.factory()
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except RetryAfter as error:
+                delay = max(delay, retry_after_seconds(error))
+                if job.attempts <= self.max_retries:
+                    logger.warning('Ограничение Telegram для чата %s, повтор '
+                                   'через %s с', chat_id, delay)
+                    jobs.appendleft(job)
+                    done = False
+                elif not job.future.done():
+                    job.future.set_exception(error)
+            except Exception as error:
+                if not job.future.done():
+                    job.future.set_exception(error)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+
+            now = loop.time()
+            self._last_sent[chat_id] = now
+            if jobs:
+                self._schedule(chat_id, now + delay)
+            else:
+                del self._chats[chat_id]
+                self._scheduled.discard(chat_id)
+                self._forget_idle(now)
+            if done:
+                await self._release()
+
+    def _forget_idle(self, now):
+        """Очистка времени отправки для давно простаивающих чатов"""
+        if len(self._last_sent) <= 2 * self.queue_size:
+            return
+        cutoff = now - self.chat_interval
+        for chat_id in [chat_id for chat_id, sent_at
+                        in self._last_sent.items() if sent_at < cutoff]:
+            del self._last_sent[chat_id]
+
+
+send_scheduler = SendScheduler()
+
+
+def telegram_request(pool_size, pool_timeout=5.0):
+    """HTTPXRequest с тайм-аутами и лимитами бота"""
+    return InstrumentedRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=10.0,
+        read_timeout=300.0,
+        write_timeout=300.0,
+        pool_timeout=pool_timeout,
+        http_version=TELEGRAM_HTTP_VERSION
+    )
+
+
+# Отдельные пулы: рассылка не занимает соединения, нужные для получения
+# обновлений и ответов пользователям
+updates_request = telegram_request(TELEGRAM_UPDATES_POOL)
+request = telegram_request(TELEGRAM_INTERACTIVE_POOL)
+# Число одновременных отправок рассылки ограничивает планировщик,
+# поэтому отправка ждёт свободного соединения без тайм-аута
+broadcast_request = telegram_request(TELEGRAM_BROADCAST_POOL,
+                                     pool_timeout=None)
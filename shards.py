@@ -0,0 +1,513 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from telegram import Bot
+
+from api import api_client
+from delivery import Delivery
+from ledger import ledger
+from logs import setup_logging, stop_logging
+from media import file_id_cache, media_cache, media_fetcher
+from metrics import (
+    broadcast_queue_depth, metrics_server, send_queue_depth, write_queue_depth
+)
+from records import PostRecord
+from sender import SendScheduler, broadcast_request
+from writer import write_behind
+from config import (
+    API_TOKEN, BROADCAST_BATCH_SIZE, BROADCAST_LEASE, BROADCAST_MAX_ATTEMPTS,
+    BROADCAST_POLL_INTERVAL, BROADCAST_QUEUE_BACKEND, BROADCAST_QUEUE_PATH,
+    BROADCAST_RETRY_DELAY, BROADCAST_WORKERS, LEDGER_TTL_HOURS,
+    MEDIA_CACHE_BYTES, MEDIA_DIR, METRICS_LISTEN, METRICS_PORT, SEND_RATE,
+    SEND_WORKERS, TELEGRAM_BASE_URL
+)
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(chat_id, shards):
+    """Номер шарда, которому принадлежит чат"""
+    try:
+        return int(chat_id) % shards
+    except (TypeError, ValueError):
+        return zlib.crc32(str(chat_id).encode()) % shards
+
+
+class SqliteQueue:
+    """Очередь заданий рассылки (outbox) в SQLite.
+
+    Рассчитана на исполнителей на одной машине: все процессы работают
+    с одним файлом базы. Задание (чат, пост) ставится в очередь один раз
+    вместе с данными поста, исполнитель захватывает задания своего шарда
+    на ``lease`` секунд и затем завершает их или отмечает ошибку.
+    Задания упавшего исполнителя по истечении срока захватываются снова,
+    поэтому рассылка переживает перезапуск. Неудачное задание повторяется
+    с растущей паузой, а после ``max_attempts`` попыток остаётся
+    в очереди со статусом ошибки. Для поста из нескольких частей
+    запоминается число уже отправленных частей, и повтор продолжается
+    со следующей. Другие хранилища подключаются через
+    ``QUEUE_BACKENDS`` с теми же методами.
+
+    Методы синхронные, и асинхронный код вызывает их в потоке
+    (``asyncio.to_thread``), чтобы ожидание блокировки базы не
+    останавливало цикл событий. Соединение общее для потоков,
+    обращения к нему разделяются блокировкой.
+    """
+
+    # Столбцы, добавленные в таблицу заданий после её появления
+    JOB_COLUMNS = {
+        'attempts': 'INTEGER NOT NULL DEFAULT 0',
+        'retry_at': 'REAL NOT NULL DEFAULT 0',
+        'failed_at': 'REAL',
+        'error': 'TEXT',
+        'parts_sent': 'INTEGER NOT NULL DEFAULT 0',
+    }
+
+    def __init__(self, path=BROADCAST_QUEUE_PATH, lease=BROADCAST_LEASE,
+                 max_attempts=BROADCAST_MAX_ATTEMPTS,
+                 retry_delay=BROADCAST_RETRY_DELAY,
+                 retention=LEDGER_TTL_HOURS * 3600):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Срок хранения заданий со статусом ошибки
+        self.retention = retention
+        self._db = None
+        self._lock = threading.RLock()
+
+    def open(self):
+        """Открытие очереди"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Транзакции открываются явно, чтобы захват был атомарным
+        self._db = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS posts ('
+                'post_id PRIMARY KEY, '
+                'payload TEXT NOT NULL, '
+                'position REAL NOT NULL) WITHOUT ROWID'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'chat_id INTEGER NOT NULL, '
+                'post_id NOT NULL, '
+                'shard INTEGER NOT NULL, '
+                'claimed_at REAL, '
+                'PRIMARY KEY (chat_id, post_id)) WITHOUT ROWID'
+            )
+            columns = {row[1] for row
+                       in self._db.execute('PRAGMA table_info(jobs)')}
+            for column, definition in self.JOB_COLUMNS.items():
+                if column not in columns:
+                    self._db.execute(
+                        f'ALTER TABLE jobs ADD COLUMN {column} {definition}'
+                    )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_shard '
+                'ON jobs (shard, claimed_at)'
+            )
+
+    def close(self):
+        """Закрытие очереди"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def put(self, posts, jobs):
+        """Постановка записей постов и заданий (шард, chat id, id поста).
+
+        Задания, которые уже стоят в очереди, не дублируются.
+        """
+        with self._transaction():
+            self._db.execute(
+                'DELETE FROM jobs WHERE failed_at < ?',
+                (time.time() - self.retention,)
+            )
+            # Посты без заданий больше не нужны исполнителям
+            self._db.execute(
+                'DELETE FROM posts WHERE post_id NOT IN '
+                '(SELECT post_id FROM jobs)'
+            )
+            self._db.executemany(
+                'INSERT OR REPLACE INTO posts (post_id, payload, position) '
+                'VALUES (?, ?, ?)',
+                [(post.id, json.dumps(post.payload, ensure_ascii=False),
+                  post.timestamp)
+                 for post in posts]
+            )
+            before = self._db.total_changes
+            self._db.executemany(
+                'INSERT OR IGNORE INTO jobs (chat_id, post_id, shard) '
+                'VALUES (?, ?, ?)',
+                [(chat_id, post_id, shard) for shard, chat_id, post_id in jobs]
+            )
+            return self._db.total_changes - before
+
+    def claim(self, shard, limit):
+        """Захват до ``limit`` свободных заданий шарда.
+
+        При ``shard=None`` захватываются задания всех шардов. Задания
+        (chat id, id поста, число отправленных частей) одного чата
+        возвращаются подряд в порядке выхода постов.
+        """
+        now = time.time()
+        with self._transaction():
+            jobs = self._db.execute(
+                'SELECT jobs.chat_id, jobs.post_id, jobs.parts_sent '
+                'FROM jobs '
+                'JOIN posts ON posts.post_id = jobs.post_id '
+                'WHERE (?1 IS NULL OR jobs.shard = ?1) '
+                'AND jobs.failed_at IS NULL AND jobs.retry_at <= ?2 '
+                'AND (jobs.claimed_at IS NULL OR jobs.claimed_at < ?3) '
+                'ORDER BY jobs.chat_id, posts.position LIMIT ?4',
+                (shard, now, now - self.lease, limit)
+            ).fetchall()
+            self._db.executemany(
+                'UPDATE jobs SET claimed_at = ? '
+                'WHERE chat_id = ? AND post_id = ?',
+                [(now, chat_id, post_id) for chat_id, post_id, _ in jobs]
+            )
+        return jobs
+
+    def posts(self, post_ids):
+        """Записи постов по id"""
+        post_ids = list(post_ids)
+        if not post_ids:
+            return {}
+        placeholders = ', '.join('?' * len(post_ids))
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT post_id, payload FROM posts '
+                f'WHERE post_id IN ({placeholders})', post_ids
+            ).fetchall()
+        return {post_id: PostRecord(json.loads(payload))
+                for post_id, payload in rows}
+
+    def complete(self, jobs):
+        """Удаление выполненных заданий (chat id, id поста)"""
+        with self._transaction():
+            self._db.executemany(
+                'DELETE FROM jobs WHERE chat_id = ? AND post_id = ?', jobs
+            )
+
+    def fail(self, jobs):
+        """Отметка неудачных заданий.
+
+        ``jobs`` — кортежи (chat id, id поста, ошибка, число
+        отправленных частей поста). Задание освобождается для повтора
+        через ``retry_delay`` секунд, и пауза удваивается с каждой
+        попыткой. После ``max_attempts`` попыток задание больше
+        не захватывается.
+        """
+        now = time.time()
+        with self._transaction():
+            self._db.executemany(
+                'UPDATE jobs SET claimed_at = NULL, error = ?, '
+                'parts_sent = ?, attempts = attempts + 1, '
+                'retry_at = ? + ? * (1 << MIN(attempts, 16)), '
+                'failed_at = CASE WHEN attempts + 1 >= ? THEN ? END '
+                'WHERE chat_id = ? AND post_id = ?',
+                [(error, parts_sent, now, self.retry_delay,
+                  self.max_attempts, now, chat_id, post_id)
+                 for chat_id, post_id, error, parts_sent in jobs]
+            )
+
+    def release(self, shard=None):
+        """Освобождение захваченных заданий шарда (всех при None).
+
+        Вызывается при запуске единственного исполнителя шарда: задания,
+        захваченные до перезапуска, продолжаются без ожидания срока.
+        """
+        with self._transaction():
+            cursor = self._db.execute(
+                'UPDATE jobs SET claimed_at = NULL '
+                'WHERE claimed_at IS NOT NULL AND (?1 IS NULL OR shard = ?1)',
+                (shard,)
+            )
+        return cursor.rowcount
+
+    def pending(self, shard=None):
+        """Число заданий в очереди без заданий со статусом ошибки"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM jobs WHERE failed_at IS NULL '
+                'AND (?1 IS NULL OR shard = ?1)', (shard,)
+            ).fetchone()[0]
+
+
+# Хранилища очереди рассылки по имени из BROADCAST_QUEUE_BACKEND
+QUEUE_BACKENDS = {
+    'sqlite': SqliteQueue,
+}
+
+
+def create_queue(backend=BROADCAST_QUEUE_BACKEND):
+    """Очередь рассылки выбранного хранилища"""
+    try:
+        return QUEUE_BACKENDS[backend]()
+    except KeyError:
+        raise EnvironmentError(
+            f'Неизвестное хранилище очереди рассылки: {backend}'
+        )
+
+
+async def plan_broadcast(users, posts, queue, shards=BROADCAST_WORKERS):
+    """План рассылки тика: недоставленные пары по шардам исполнителей.
+
+    Возвращает число новых заданий в очереди.
+    """
+    # Исполнители отмечают доставку в общем журнале
+    ledger.refresh()
+    jobs = []
+    for user in users:
+        user_id = user.chat_id
+        shard = shard_of(user_id, shards)
+        for post in posts:
+            if not ledger.is_delivered(user_id, post.id):
+                jobs.append((shard, user_id, post.id))
+    return await asyncio.to_thread(queue.put, posts, jobs)
+
+
+class ShardWorker:
+    """Исполнитель рассылки для одного шарда чатов.
+
+    Забирает задания своего шарда из очереди, отправляет посты через
+    собственный планировщик и отмечает доставку в журнале. Лимит
+    отправки бота делится поровну между шардами.
+    """
+
+    def __init__(self, shard, shards, queue,
+                 batch_size=BROADCAST_BATCH_SIZE,
+                 poll_interval=BROADCAST_POLL_INTERVAL, scheduler=None):
+        self.shard = shard
+        self.shards = shards
+        self.queue = queue
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.scheduler = scheduler or SendScheduler(
+            rate=SEND_RATE / shards, workers=max(1, SEND_WORKERS // shards)
+        )
+        # id поста -> части поста
+        self.compiled = {}
+
+    async def run(self, stop):
+        """Обработка очереди до установки события ``stop``"""
+        self.scheduler.start()
+        try:
+            async with Bot(API_TOKEN, base_url=TELEGRAM_BASE_URL,
+                           request=broadcast_request) as bot:
+                delivery = Delivery(bot, self.scheduler)
+                logger.info('Исполнитель шарда %s/%s запущен',
+                            self.shard, self.shards)
+                while not stop.is_set():
+                    if await self.drain(delivery, stop):
+                        continue
+                    # Очередь пуста: временные файлы больше не нужны
+                    delivery.cleanup()
+                    self.compiled.clear()
+                    try:
+                        ledger.prune_due()
+                    except sqlite3.Error as error:
+                        logger.error('Ошибка очистки журнала доставки: %s',
+                                     error)
+                    try:
+                        await asyncio.wait_for(stop.wait(),
+                                               self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                delivery.cleanup()
+        finally:
+            await self.scheduler.stop()
+
+    async def drain(self, delivery, stop=None):
+        """Обработка доступных заданий, пока они есть в очереди.
+
+        Возвращает число обработанных заданий. Задания с отложенным
+        повтором остаются в очереди до следующего вызова. Ошибка обработки
+        пакета записывается в лог и прерывает проход: захваченные задания
+        снова станут доступны после истечения аренды.
+        """
+        processed = 0
+        while stop is None or not stop.is_set():
+            try:
+                jobs = await asyncio.to_thread(self.queue.claim, self.shard,
+                                               self.batch_size)
+                if not jobs:
+                    break
+                await self.process(delivery, jobs)
+            except Exception as error:
+                logger.error('Ошибка обработки заданий шарда %s: %s',
+                             self.shard, error)
+                break
+            processed += len(jobs)
+        return processed
+
+    async def process(self, delivery, jobs):
+        """Отправка захваченных заданий"""
+        missing = {post_id for _, post_id, _ in jobs} - self.compiled.keys()
+        posts = await asyncio.to_thread(self.queue.posts, missing)
+        for post_id, post in posts.items():
+            self.compiled[post_id] = post.parts
+
+        by_chat = {}
+        for chat_id, post_id, parts_sent in jobs:
+            by_chat.setdefault(chat_id, []).append((post_id, parts_sent))
+        delivered = []
+
+        failed = []
+
+        async def process_chat(chat_id, chat_jobs):
+            # Посты одного чата отправляются по порядку
+            for post_id, parts_sent in chat_jobs:
+                parts = self.compiled.get(post_id)
+                if (parts is None or chat_id in delivery.blocked
+                        or ledger.is_delivered(chat_id, post_id)):
+                    continue
+                if await delivery.deliver(chat_id, post_id, parts,
+                                          parts_sent):
+                    delivered.append((chat_id, post_id))
+                elif chat_id not in delivery.blocked:
+                    failed.append((chat_id, post_id,
+                                   delivery.errors.get(chat_id),
+                                   delivery.progress.get(chat_id,
+                                                         parts_sent)))
+
+        await asyncio.gather(*(process_chat(chat_id, chat_jobs)
+                               for chat_id, chat_jobs in by_chat.items()))
+        # Журнал доставки пишется до завершения заданий: после сбоя
+        # между записями задание повторится, но пост не отправится дважды
+        ledger.mark_delivered(delivered)
+        if failed:
+            await asyncio.to_thread(self.queue.fail, failed)
+            failed_keys = {(chat_id, post_id)
+                           for chat_id, post_id, _, _ in failed}
+            jobs = [job for job in jobs if tuple(job[:2]) not in failed_keys]
+        # Доставленные задания, задания заблокированных чатов и постов,
+        # уже удалённых из очереди, завершаются
+        await asyncio.to_thread(self.queue.complete,
+                                [(chat_id, post_id)
+                                 for chat_id, post_id, _ in jobs])
+
+
+async def serve_shard(shard, shards=BROADCAST_WORKERS):
+    """Запуск исполнителя шарда с общими ресурсами процесса"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    # У каждого исполнителя свой кэш медиафайлов: файлы, которые
+    # отправляет один процесс, не удаляются другим при вытеснении
+    media_cache.directory = os.path.join(MEDIA_DIR, f'shard-{shard}')
+    media_cache.budget = MEDIA_CACHE_BYTES // shards
+    queue = create_queue()
+    queue.open()
+    # У шарда один исполнитель: захваченное до перезапуска продолжается
+    # сразу, без ожидания срока захвата
+    released = queue.release(shard)
+    if released:
+        logger.info('Шард %s: продолжаются прерванные задания: %s',
+                    shard, released)
+    await api_client.start()
+    ledger.open()
+    file_id_cache.open()
+    media_cache.open()
+    write_behind.start()
+    worker = ShardWorker(shard, shards, queue)
+    send_queue_depth.set_function(lambda: worker.scheduler.pending)
+    write_queue_depth.set_function(lambda: len(write_behind))
+    broadcast_queue_depth.set_function(lambda: queue.pending(shard))
+    if METRICS_PORT:
+        await metrics_server.start(METRICS_LISTEN, METRICS_PORT + 1 + shard)
+    try:
+        await worker.run(stop)
+    finally:
+        await metrics_server.stop()
+        await write_behind.stop()
+        await media_fetcher.close()
+        file_id_cache.close()
+        media_cache.close()
+        await api_client.close()
+        ledger.close()
+        queue.close()
+        logger.info('Исполнитель шарда %s/%s остановлен', shard, shards)
+
+
+def run_shard(shard, shards=BROADCAST_WORKERS):
+    """Точка входа процесса-исполнителя"""
+    setup_logging()
+    try:
+        asyncio.run(serve_shard(shard, shards))
+    finally:
+        stop_logging()
+
+
+def start_workers(shards=BROADCAST_WORKERS):
+    """Запуск процессов-исполнителей всех шардов"""
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for shard in range(shards):
+        process = context.Process(target=run_shard, args=(shard, shards),
+                                  name=f'broadcast-shard-{shard}',
+                                  daemon=True)
+        process.start()
+        processes.append(process)
+    logger.info('Запущено исполнителей рассылки: %s', shards)
+    return processes
+
+
+def stop_workers(processes, timeout=30):
+    """Остановка процессов-исполнителей"""
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            logger.error('Исполнитель %s не остановился', process.name)
+            process.kill()
+
+
+broadcast_queue = create_queue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Исполнитель шарда рассылки'
+    )
+    parser.add_argument('shard', type=int, help='номер шарда')
+    parser.add_argument('--shards', type=int, default=BROADCAST_WORKERS,
+                        help='общее число шардов')
+    args = parser.parse_args()
+    if not 0 <= args.shard < args.shards:
+        parser.error('номер шарда должен быть меньше числа шардов')
+    run_shard(args.shard, args.shards)
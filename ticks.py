@@ -0,0 +1,156 @@
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from metrics import tick_duration, ticks_merged, ticks_skipped
+from windows import window_index
+from config import TICK_MAX_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class TickRunner:
+    """Тики рассылки без наложения друг на друга.
+
+    Тик состоит из плана, который записывает задания в очередь рассылки,
+    и доставки, которая забирает задания из очереди, пока они есть.
+    Одновременно строится не больше одного плана и идёт не больше одной
+    доставки. Тик, пришедший во время доставки предыдущего, только
+    записывает свой план, а его задания забирает уже идущая доставка.
+    Тик, пришедший, пока предыдущий план ещё строится, пропускается.
+    Отставание от самого раннего незавершённого тика доступно
+    через ``lag``.
+    """
+
+    def __init__(self, plan, deliver=None):
+        # plan() — запись плана тика в очередь
+        self.plan = plan
+        # deliver(context) — доставка заданий очереди; None, если
+        # доставку выполняют другие процессы
+        self.deliver = deliver
+        self.planning = False
+        self.delivering = False
+        # Во время доставки были записаны новые задания
+        self._merged = False
+        # Время прихода самого раннего тика, работа которого не завершена
+        self.behind_since = None
+
+    def lag(self):
+        """Отставание в секундах от самого раннего незавершённого тика"""
+        if self.behind_since is None:
+            return 0.0
+        return time.monotonic() - self.behind_since
+
+    async def run(self, context, plan=True):
+        """Выполнение тика; ``plan=False`` — только доставка очереди"""
+        started = time.monotonic()
+        if plan:
+            if self.planning:
+                ticks_skipped.inc()
+                logger.warning('План предыдущего тика ещё строится, '
+                               'тик пропущен')
+                return
+            if self.behind_since is None:
+                self.behind_since = started
+            self.planning = True
+            try:
+                await self.plan()
+            except Exception as e:
+                logger.error('Ошибка при планировании рассылки: %s', e)
+            finally:
+                self.planning = False
+
+        if self.deliver is None:
+            self.behind_since = None
+        elif self.delivering:
+            self._merged = True
+            ticks_merged.inc()
+            logger.info('Задания тика переданы выполняющейся доставке, '
+                        'отставание %.0f с', self.lag())
+        else:
+            if self.behind_since is None:
+                self.behind_since = started
+            self.delivering = True
+            try:
+                while True:
+                    self._merged = False
+                    await self.deliver(context)
+                    # Задания тиков, записанные во время доставки,
+                    # забираются тем же проходом
+                    if not self._merged:
+                        break
+            except Exception as e:
+                logger.error('Ошибка при рассылке новостей: %s', e)
+            finally:
+                self.delivering = False
+                self.behind_since = None
+        tick_duration.set(time.monotonic() - started)
+
+
+class TickScheduler:
+    """Запуск тиков по событиям вместо опроса с постоянным интервалом.
+
+    Следующий тик ставится в очередь задач на минуту открытия
+    ближайшего окна рассылки, но не позже ``max_interval`` секунд.
+    ``wake`` переносит тик на более раннее время, например при появлении
+    новых постов или изменении окна пользователя.
+    """
+
+    def __init__(self, callback, windows=window_index,
+                 max_interval=TICK_MAX_INTERVAL):
+        # callback(context) — тик рассылки
+        self.callback = callback
+        self.windows = windows
+        self.max_interval = max_interval
+        self.job_queue = None
+        # Запланированный тик и время его запуска
+        self.job = None
+        self.due = None
+
+    def start(self, job_queue, first=0):
+        """Планирование первого тика"""
+        self.job_queue = job_queue
+        self.wake(first)
+
+    def next_delay(self, now_utc=None):
+        """Секунды до ближайшего открытия окна или до предельной паузы"""
+        now_utc = now_utc or datetime.now(timezone.utc)
+        delay = self.max_interval
+        minutes = self.windows.next_opening(now_utc.hour * 60
+                                            + now_utc.minute)
+        if minutes is not None:
+            elapsed = now_utc.second + now_utc.microsecond / 1e6
+            # Секунда запаса: тик приходится на минуту открытия окна
+            delay = min(delay, minutes * 60 - elapsed + 1)
+        return max(delay, 0)
+
+    def wake(self, delay=0):
+        """Тик не позже чем через ``delay`` секунд"""
+        if self.job_queue is None:
+            return
+        when = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        if self.job is not None:
+            if self.due <= when:
+                return
+            self.job.schedule_removal()
+        self.due = when
+        self.job = self.job_queue.run_once(self._fire, delay,
+                                           name='news_tick')
+
+    def on_change(self, previous, current):
+        """Обработчик изменений зеркала пользователей"""
+        if previous is not None and (previous.active == current.active
+                                     and previous.intervals
+                                     == current.intervals):
+            return
+        now_utc = datetime.now(timezone.utc)
+        if current.is_open(now_utc.hour * 60 + now_utc.minute):
+            self.wake()
+        else:
+            # Окно может открыться раньше запланированного тика
+            self.wake(self.next_delay(now_utc))
+
+    async def _fire(self, context):
+        self.job = None
+        self.wake(self.next_delay())
+        await self.callback(context)
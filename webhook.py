@@ -0,0 +1,163 @@
+import asyncio
+import hmac
+import logging
+import signal
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import (
+    WEBHOOK_LISTEN, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_PATH, WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE, WEBHOOK_SECRET_TOKEN, WEBHOOK_URL
+)
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передаёт секрет вебхука
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов.
+
+    Общее число обрабатываемых обновлений ограничено, а обновления
+    одного чата обрабатываются по порядку, поэтому состояния
+    ConversationHandler не перемешиваются. ``in_flight`` — число
+    обновлений, взятых из очереди приложения, но ещё не обработанных.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # chat id -> [блокировка, число ожидающих обновлений]
+        self._chats = {}
+        self.in_flight = 0
+
+    async def process_update(self, update, coroutine):
+        self.in_flight += 1
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            self.in_flight -= 1
+
+    async def _process_in_order(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Блокировка чата берётся до общего лимита, чтобы ожидающие
+            # обновления одного чата не занимали места других чатов
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def unfinished_updates(application):
+    """Число принятых, но ещё не обработанных обновлений.
+
+    При параллельной обработке приложение сразу забирает обновление
+    из очереди и запускает его задачей, поэтому к длине очереди
+    добавляются обновления, которые обрабатываются или ждут своей
+    очереди в ``ChatUpdateProcessor``.
+    """
+    processor = application.update_processor
+    return (application.update_queue.qsize()
+            + getattr(processor, 'in_flight', 0))
+
+
+def create_web_app(application, path=WEBHOOK_PATH,
+                   secret_token=WEBHOOK_SECRET_TOKEN,
+                   queue_size=WEBHOOK_QUEUE_SIZE):
+    """aiohttp-приложение, принимающее обновления Telegram"""
+
+    async def receive_update(request):
+        if secret_token and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ''), secret_token
+        ):
+            logger.warning('Отклонено обновление с неверным секретом от %s',
+                           request.remote)
+            return web.Response(status=403)
+        if unfinished_updates(application) >= queue_size:
+            # Telegram повторит доставку позже
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            update = Update.de_json(data, application.bot)
+        except (KeyError, TypeError, AttributeError, ValueError) as error:
+            # JSON разобран, но не является обновлением Telegram
+            logger.warning('Отклонено некорректное обновление от %s: %r',
+                           request.remote, error)
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    web_app = web.Application()
+    web_app.router.add_post(path, receive_update)
+    return web_app
+
+
+async def serve_webhook(application, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                        url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN):
+    """Работа приложения в режиме вебхука до сигнала остановки.
+
+    Жизненный цикл повторяет ``Application.run_polling``: post_init
+    после инициализации, post_stop и post_shutdown при остановке.
+    Без ``url`` вебхук в Telegram не регистрируется, и обновления
+    можно отправлять на локальный адрес вручную.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    runner = web.AppRunner(create_web_app(application,
+                                          secret_token=secret_token))
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if url:
+            await application.bot.set_webhook(
+                url=url, secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info('Вебхук принимает обновления на %s:%s', host, port)
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application):
+    """Запуск приложения в режиме вебхука"""
+    asyncio.run(serve_webhook(application))
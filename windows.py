@@ -0,0 +1,87 @@
+import logging
+from bisect import bisect_right, insort
+
+from records import MINUTES_IN_DAY
+
+logger = logging.getLogger(__name__)
+
+
+class WindowIndex:
+    """Индекс окон рассылки активных пользователей.
+
+    Пользователи группируются по интервалам UTC, поэтому запрос
+    «у кого открыто окно в минуту M» перебирает только различные
+    интервалы, а не всех пользователей.
+    """
+
+    def __init__(self):
+        # (начало, конец) -> множество chat id
+        self.by_interval = {}
+        # Интервалы, отсортированные по началу
+        self.intervals = []
+        # chat id -> список интервалов пользователя
+        self.user_intervals = {}
+
+    def __len__(self):
+        return len(self.user_intervals)
+
+    def remove(self, chat_id):
+        """Удаление пользователя из индекса"""
+        for interval in self.user_intervals.pop(chat_id, ()):
+            chat_ids = self.by_interval[interval]
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                del self.by_interval[interval]
+                self.intervals.remove(interval)
+
+    def add(self, user):
+        """Добавление или обновление записи пользователя в индексе"""
+        chat_id = user.chat_id
+        self.remove(chat_id)
+        if not user.active:
+            return
+        intervals = user.intervals
+        if intervals is None:
+            logger.error('Некорректные настройки времени пользователя %s: '
+                         '%s-%s %s', chat_id, user.start_time, user.end_time,
+                         user.time_zone)
+            return
+        for interval in intervals:
+            if interval not in self.by_interval:
+                self.by_interval[interval] = set()
+                insort(self.intervals, interval)
+            self.by_interval[interval].add(chat_id)
+        self.user_intervals[chat_id] = intervals
+
+    def on_change(self, previous, current):
+        """Обработчик изменений зеркала пользователей"""
+        # Интервалы записей разобраны заранее, поэтому сравниваются
+        # только они и признак активности
+        if (previous is None or previous.active != current.active
+                or previous.intervals != current.intervals):
+            self.add(current)
+
+    def next_opening(self, minute):
+        """Через сколько минут после минуты UTC начнётся ближайшее окно.
+
+        None, если в индексе нет окон.
+        """
+        if not self.intervals:
+            return None
+        position = bisect_right(self.intervals, (minute, MINUTES_IN_DAY))
+        if position < len(self.intervals):
+            return self.intervals[position][0] - minute
+        return self.intervals[0][0] + MINUTES_IN_DAY - minute
+
+    def open_at(self, minute):
+        """chat id пользователей, у которых открыто окно в минуту UTC"""
+        # Интервалы с началом не позже minute
+        position = bisect_right(self.intervals, (minute, MINUTES_IN_DAY))
+        chat_ids = set()
+        for start, end in self.intervals[:position]:
+            if minute <= end:
+                chat_ids |= self.by_interval[(start, end)]
+        return chat_ids
+
+
+window_index = WindowIndex()
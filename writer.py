@@ -0,0 +1,197 @@
+import asyncio
+import logging
+
+from api import (
+    ApiError, TransientApiError, bulk_update_users, create_user, patch_user
+)
+from config import (
+    API_URL_USER_BULK, WRITE_BATCH_SIZE, WRITE_CONCURRENCY,
+    WRITE_FLUSH_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """Отложенная запись изменений пользователей в API.
+
+    Изменения одного пользователя объединяются, пока ждут отправки.
+    Очередь сбрасывается по достижении ``batch_size`` пользователей или
+    раз в ``flush_interval`` секунд: одним пакетным запросом, если задан
+    ``API_URL_USER_BULK``, иначе параллельными запросами. При временной
+    недоступности API или отмене записи изменения возвращаются в очередь.
+    """
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_INTERVAL,
+                 concurrency=WRITE_CONCURRENCY, bulk=bool(API_URL_USER_BULK)):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.concurrency = concurrency
+        self.bulk = bulk
+        # chat id -> объединённые изменения
+        self.pending = {}
+        # chat id пользователей, которых нужно создать
+        self.creates = set()
+        self._listeners = []
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    def subscribe(self, callback):
+        """Подписка на ответы API: callback(данные пользователя)"""
+        self._listeners.append(callback)
+
+    def update(self, chat_id, data):
+        """Постановка изменения пользователя в очередь"""
+        self.pending.setdefault(chat_id, {}).update(data)
+        if self._wakeup is not None and len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def create(self, chat_id, data):
+        """Постановка создания пользователя в очередь"""
+        self.creates.add(chat_id)
+        self.update(chat_id, data)
+
+    def start(self):
+        """Запуск фонового сброса очереди"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка с отправкой всех накопленных изменений"""
+        if self._task is not None:
+            # Идущий сброс дожидается завершения, а не отменяется:
+            # его изменения уже изъяты из очереди
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._stopping = False
+        await self.flush()
+        if self.pending:
+            logger.error('Не записаны изменения пользователей: %s',
+                         len(self.pending))
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                # Оставшееся отправит stop()
+                break
+            try:
+                await self.flush()
+            except Exception as error:
+                logger.error('Ошибка записи изменений пользователей: %s',
+                             error)
+
+    async def flush(self):
+        """Отправка накопленных изменений"""
+        while self.pending:
+            batch = dict(list(self.pending.items())[:self.batch_size])
+            for chat_id in batch:
+                del self.pending[chat_id]
+            creates = {chat_id: batch.pop(chat_id)
+                       for chat_id in self.creates & batch.keys()}
+            self.creates -= creates.keys()
+            results = await asyncio.gather(self._write_creates(creates),
+                                           self._write_updates(batch))
+            if not all(results):
+                # API недоступен: остальное дождётся следующего сброса
+                break
+
+    async def _write_creates(self, batch):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def write(chat_id, data):
+            async with semaphore:
+                try:
+                    return await create_user(dict(data, id=chat_id))
+                except (TransientApiError, asyncio.CancelledError):
+                    self.requeue(chat_id, data, create=True)
+                    raise
+        return await self._gather(batch, write)
+
+    async def _write_updates(self, batch):
+        if not batch:
+            return True
+        if self.bulk:
+            records = [dict(data, id=chat_id)
+                       for chat_id, data in batch.items()]
+            try:
+                result = await bulk_update_users(records)
+            except asyncio.CancelledError:
+                for chat_id, data in batch.items():
+                    self.requeue(chat_id, data)
+                raise
+            except TransientApiError as error:
+                logger.error('Пакетная запись отложена: %s', error)
+                for chat_id, data in batch.items():
+                    self.requeue(chat_id, data)
+                return False
+            except ApiError as error:
+                logger.error('Ошибка пакетной записи: %s', error)
+                return True
+            logger.info('Записаны изменения пользователей: %s', len(batch))
+            if isinstance(result, list):
+                for user in result:
+                    self._notify(user)
+            return True
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def write(chat_id, data):
+            async with semaphore:
+                try:
+                    return await patch_user(chat_id, data)
+                except (TransientApiError, asyncio.CancelledError):
+                    self.requeue(chat_id, data)
+                    raise
+        return await self._gather(batch, write)
+
+    async def _gather(self, batch, write):
+        """Параллельная запись; False, если API временно недоступен"""
+        if not batch:
+            return True
+        results = await asyncio.gather(
+            *(write(chat_id, data) for chat_id, data in batch.items()),
+            return_exceptions=True
+        )
+        available = True
+        written = 0
+        for (chat_id, _), result in zip(batch.items(), results):
+            if isinstance(result, TransientApiError):
+                available = False
+            elif isinstance(result, Exception):
+                logger.error('Ошибка записи данных пользователя %s: %s',
+                             chat_id, result)
+            else:
+                written += 1
+                if result:
+                    self._notify(dict(result, id=chat_id))
+        logger.info('Записаны изменения пользователей: %s', written)
+        return available
+
+    def requeue(self, chat_id, data, create=False):
+        """Возврат изменений в очередь под более новыми изменениями"""
+        self.pending[chat_id] = dict(data, **self.pending.get(chat_id, {}))
+        if create:
+            self.creates.add(chat_id)
+
+    def _notify(self, user):
+        # Ответ API устарел, если пользователь уже изменён снова
+        if isinstance(user, dict) and user.get('id') not in self.pending:
+            for callback in self._listeners:
+                callback(user)
+
+
+write_behind = WriteBehind()
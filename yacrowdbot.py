@@ -1,27 +1,51 @@
 import asyncio
 from datetime import datetime, timedelta
 import logging
-import requests
 import pytz
-import os
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters,
     ContextTypes, ConversationHandler, CallbackQueryHandler
 )
-from telegram.error import TelegramError
 
-from api import get_user, update_user, store_user, get_posts, get_users
-from config import API_TOKEN, request
+from api import ApiError, api_client
+from delivery import Delivery
+from feed import post_feed
+from ledger import ledger
+from logs import setup_logging, stop_logging
+from roster import roster
+from media import file_id_cache, media_cache, media_fetcher
+from metrics import (
+    broadcast_queue_depth, eligible_users, metrics_server, send_queue_depth,
+    tick_lag, write_queue_depth
+)
+from sender import (
+    broadcast_request, request, send_scheduler, updates_request
+)
+from ticks import TickRunner, TickScheduler
+from shards import (
+    ShardWorker, broadcast_queue, plan_broadcast, start_workers, stop_workers
+)
+from webhook import ChatUpdateProcessor, run_webhook
+from windows import window_index
+from writer import write_behind
+from config import (
+    API_TOKEN, BROADCAST_SPAWN_WORKERS, BROADCAST_WORKERS,
+    METRICS_LISTEN, METRICS_PORT, POSTS_POLL_INTERVAL,
+    ROSTER_SYNC_INTERVAL, TELEGRAM_BASE_URL, UPDATE_CONCURRENCY, UPDATE_MODE
+)
 
-# Настройка логирования
-logging.basicConfig(format='%(asctime)s-%(name)s-%(levelname)s-%(message)s',
-                    level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Словарь для отслеживания последнего отправленного поста для каждого пользователя
-last_sent_posts = {}
+# Рассылка в основном процессе идёт через отдельный пул соединений,
+# чтобы не задерживать ответы пользователям
+broadcast_bot = Bot(API_TOKEN, base_url=TELEGRAM_BASE_URL,
+                    request=broadcast_request)
+
+# Рассылка из очереди заданий в основном процессе, без исполнителей шардов
+outbox_worker = ShardWorker(None, 1, broadcast_queue,
+                            scheduler=send_scheduler)
 
 # Определение состояний для ConversationHandler
 SET_TIME, SET_TIME_ZONE = range(2)
@@ -53,36 +77,37 @@ async def say_hi(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     except Exception as e:
         logger.error('Ошибка при отправке приветственного сообщения '
-                     f'пользователю {chat.id}: {e}')
+                     'пользователю %s: %s', chat.id, e)
 
 
 async def change_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Инициация смены времени рассылки"""
     chat = update.effective_chat
-    response = await get_user(chat.id)
+    user = await roster.fetch(chat.id)
 
-    start_time = response.get('start_time')
-    end_time = response.get('end_time')
+    start_time = user.start_time if user else None
+    end_time = user.end_time if user else None
 
     # Преобразование времени из формата чч:мм:сс в чч:мм
-    if len(start_time) > 5:
-        start_time = start_time[:5]
-    if len(end_time) > 5:
-        end_time = end_time[:5]
+    if start_time and end_time:
+        settings = f'{start_time[:5]}-{end_time[:5]}'
+    else:
+        # Пользователь ещё не записан в API
+        settings = 'не заданы'
 
     keyboard = KEYBOARD_CANCEL
     reply_markup = InlineKeyboardMarkup(keyboard)
     await context.bot.send_message(
         chat_id=chat.id,
         text=(
-            f'Текущие настройки времени: {start_time}-{end_time}\n'
+            f'Текущие настройки времени: {settings}\n'
             'Для смены времени отправки новостей введите интервал времени '
             'в формате: чч:мм-чч:мм'
         ),
         reply_markup=reply_markup
     )
-    logger.info(f'Пользователь {chat.id} запросил смену времени. '
-                f'Текущие настройки: {start_time}-{end_time}')
+    logger.info('Пользователь %s запросил смену времени. Текущие настройки: '
+                '%s', chat.id, settings)
     return SET_TIME
 
 
@@ -90,7 +115,7 @@ async def set_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Установка времени рассылки"""
     chat = update.effective_chat
     message = update.message.text
-    logger.info(f'Получено сообщение от пользователя {chat.id}: {message}')
+    logger.info('Получено сообщение от пользователя %s: %s', chat.id, message)
     keyboard = KEYBOARD_CANCEL
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -101,7 +126,7 @@ async def set_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if (0 <= start_hour < 24 and 0 <= start_minute < 60
                 and 0 <= end_hour < 24 and 0 <= end_minute < 60):
-            await update_user(chat.id, {
+            await roster.update(chat.id, {
                 'start_time': f'{start_hour:02}:{start_minute:02}',
                 'end_time': f'{end_hour:02}:{end_minute:02}'
             })
@@ -114,9 +139,9 @@ async def set_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f'{end_hour:02}:{end_minute:02}'
                 )
             )
-            logger.info(f'Время обновлено для пользователя {chat.id} на: '
-                        f'{start_hour:02}:{start_minute:02}-'
-                        f'{end_hour:02}:{end_minute:02}')
+            logger.info('Время обновлено для пользователя %s на: '
+                        '%02d:%02d-%02d:%02d', chat.id,
+                        start_hour, start_minute, end_hour, end_minute)
             return ConversationHandler.END
         else:
             await context.bot.send_message(
@@ -127,8 +152,8 @@ async def set_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return SET_TIME
     except ValueError:
-        logger.error(f'Неверный формат времени от пользователя {chat.id}: '
-                     f'{message}', exc_info=True)
+        logger.error('Неверный формат времени от пользователя %s: %s',
+                     chat.id, message, exc_info=True)
         await context.bot.send_message(
             chat_id=chat.id,
             text='Неверный формат времени. Пожалуйста, используйте формат: '
@@ -141,9 +166,9 @@ async def set_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def change_time_zone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Инициализация смены часового пояса"""
     chat = update.effective_chat
-    response = await get_user(chat.id)
+    user = await roster.fetch(chat.id)
 
-    time_zone = response.get('time_zone')
+    time_zone = (user.time_zone if user else None) or 'не задан'
 
     keyboard = KEYBOARD_CANCEL
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -156,15 +181,15 @@ async def change_time_zone(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-    logger.info(f'Пользователь {chat.id} запросил смену часового пояса. '
-                f'Текущие настройки: {time_zone}')
+    logger.info('Пользователь %s запросил смену часового пояса. Текущие '
+                'настройки: %s', chat.id, time_zone)
     return SET_TIME_ZONE
 
 
 async def set_time_zone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     message = update.message.text.strip()
-    logger.info(f'Получено сообщение от пользователя {chat_id}: {message}')
+    logger.info('Получено сообщение от пользователя %s: %s', chat_id, message)
     keyboard = KEYBOARD_CANCEL
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -185,24 +210,25 @@ async def set_time_zone(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sign = message[0]
         formatted_time_zone = f'{sign}{hours:02}:{minutes:02}'
 
-        logger.info('Обновление часового пояса для пользователя '
-                    f'{chat_id} на {formatted_time_zone}')
+        logger.info('Обновление часового пояса для пользователя %s на %s',
+                    chat_id, formatted_time_zone)
 
-        updated_user = await update_user(chat_id,
-                                         {'time_zone': formatted_time_zone})
+        updated_user = await roster.update(
+            chat_id, {'time_zone': formatted_time_zone}
+        )
 
         if (updated_user
-                and updated_user.get('time_zone') == formatted_time_zone):
+                and updated_user.time_zone == formatted_time_zone):
             await context.bot.send_message(
                 chat_id=chat_id,
                 text='Ваш часовой пояс успешно установлен на '
                      f'{formatted_time_zone}!')
-            logger.info(f'Часовой пояс пользователя {chat_id} установлен на '
-                        f'{formatted_time_zone}')
+            logger.info('Часовой пояс пользователя %s установлен на %s',
+                        chat_id, formatted_time_zone)
             return ConversationHandler.END
         else:
             logger.error('Не удалось обновить часовой пояс для пользователя '
-                         f'{chat_id}.')
+                         '%s.', chat_id)
             await context.bot.send_message(
                 chat_id=chat_id,
                 text='Не удалось обновить часовой пояс. Попробуйте позже.')
@@ -219,7 +245,7 @@ async def set_time_zone(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         logger.error('Ошибка при установке часового пояса для пользователя '
-                     f'{chat_id}: {error}')
+                     '%s: %s', chat_id, error)
         return SET_TIME_ZONE
 
 
@@ -230,200 +256,115 @@ async def wake_up(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(DEFAULT_KEYBOARD)
 
     try:
-        user = await get_user(chat.id)
+        user = await roster.fetch(chat.id)
         if not user:
-            await store_user(chat.id, name)
-            logger.info(f'Новый пользователь {chat.id} ({name}) добавлен в БД')
+            await roster.store(chat.id, name)
+            logger.info('Новый пользователь %s (%s) добавлен в БД',
+                        chat.id, name)
         else:
-            await update_user(chat.id, {'active': True})
-            logger.info(f'Пользователь {chat.id} ({name}) активировал бота.')
+            await roster.update(chat.id, {'active': True})
+            logger.info('Пользователь %s (%s) активировал бота.',
+                        chat.id, name)
     except Exception as e:
-        logger.error('Ошибка при работе с таблицей Users для пользователя '
-                     f'{chat.id} ({name}): {e}')
+        logger.error('Ошибка при работе с таблицей Users для пользователя %s '
+                     '(%s): %s', chat.id, name, e)
 
     await context.bot.send_message(
         chat_id=chat.id,
         text=f'Спасибо, что включили меня, {name}!',
         reply_markup=reply_markup
     )
-    logger.debug(f'Отправлено сообщение о запуске бота пользователю {chat.id}')
+    logger.debug('Отправлено сообщение о запуске бота пользователю %s',
+                 chat.id)
+
+
+async def plan_news():
+    """План рассылки тика в очереди заданий; число новых заданий"""
+    eligible_users.set(0)
+    now_utc = datetime.now(pytz.utc)
+    posts = await post_feed.refresh(now_utc)
+    # Граница суток не зависит от часового пояса пользователя,
+    # поэтому выборка постов одна на весь тик
+    cutoff = (now_utc - timedelta(hours=24)).timestamp()
+    eligible_posts = posts.since(cutoff)
+    if not eligible_posts:
+        logger.info('Нет новых постов для рассылки.')
+        return 0
+    ledger.prune_due()
+
+    # Из локального зеркала берутся только пользователи с открытым
+    # окном рассылки
+    now_minute = now_utc.hour * 60 + now_utc.minute
+    users = [roster.get(chat_id)
+             for chat_id in window_index.open_at(now_minute)]
+    eligible_users.set(len(users))
+    if not users:
+        logger.info('Нет пользователей с открытым окном рассылки.')
+        return 0
+
+    planned = await plan_broadcast(users, eligible_posts, broadcast_queue,
+                                   max(BROADCAST_WORKERS, 1))
+    logger.info('Запланировано отправок: %s, в очереди: %s',
+                planned, await asyncio.to_thread(broadcast_queue.pending))
+    return planned
+
+
+async def drain_outbox(context: ContextTypes.DEFAULT_TYPE):
+    """Доставка заданий очереди рассылки в основном процессе"""
+    delivery = Delivery(broadcast_bot)
+    try:
+        processed = await outbox_worker.drain(delivery)
+    finally:
+        # Удаление временных файлов после рассылки всем пользователям
+        delivery.cleanup()
+        outbox_worker.compiled.clear()
+    if processed:
+        logger.info('Обработано заданий рассылки: %s, осталось: %s',
+                    processed,
+                    await asyncio.to_thread(broadcast_queue.pending))
 
 
-def convert_time_zone(time_zone):
-    sign = time_zone[0]
-    hours, minutes = map(int, time_zone[1:].split(':'))
-    offset = hours * 60 + minutes
-    if sign == '-':
-        offset = -offset
-    return pytz.FixedOffset(offset)
+# Тики рассылки по одному
+news_ticks = TickRunner(plan_news, None if BROADCAST_WORKERS else drain_outbox)
 
 
-async def handle_block_error(chat_id):
-    """Обработка ошибки блокировки бота пользователем"""
-    try:
-        await update_user(chat_id, {'active': False})
-        logging.info(f'Пользователь {chat_id} заблокировал бота. '
-                     'Маркер активности был изменен в БД.')
-    except Exception as e:
-        logging.error(f'Ошибка обновления статуса пользователя {chat_id}: {e}')
+async def send_news(context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка новостей.
 
+    План тика записывается в очередь заданий один раз, а отправку
+    выполняют исполнители шардов или, без них, основной процесс.
+    Очередь хранится на диске, поэтому рассылка, прерванная сбоем
+    или перезапуском, продолжается, а доставленное не повторяется.
+    Тики не накладываются друг на друга: задания опоздавшего тика
+    забирает уже идущая доставка.
+    """
+    await news_ticks.run(context)
 
-async def send_news(context: ContextTypes.DEFAULT_TYPE):
-    """Рассылка новостей"""
-    try:
-        posts = await get_posts()
-        now_utc = datetime.now(pytz.utc)
 
-        users = await get_users()
-        if not users:
-            logger.info('Нет активных пользователей для рассылки новостей.')
-            return
+async def resume_news(context: ContextTypes.DEFAULT_TYPE):
+    """Доставка остатка рассылки, прерванной перезапуском"""
+    await news_ticks.run(context, plan=False)
 
-        # Временное хранилище для загруженных видео
-        video_cache = {}
-
-        async def send_post(user, post):
-            """Асинхронная отправка постов"""
-            user_id = user['id']
-            post_content = f"{post['title']}\n\n{post['text']}"
-            logger.info(f"Отправка поста пользователю {user_id}: {post['id']}")
-            await context.bot.send_message(chat_id=user_id, text=post_content)
-
-            if post.get('image'):
-                for image_url in post['image']:
-                    try:
-                        response = requests.get(image_url)
-                        # Проверка на успешный статус код
-                        response.raise_for_status()
-                        await context.bot.send_photo(chat_id=user_id,
-                                                     photo=image_url)
-                        logger.info('Изображение отправлено пользователю: '
-                                    f'{user_id}')
-                    except requests.exceptions.RequestException as e:
-                        logger.error('Ошибка при получении изображения '
-                                     f'{image_url}: {e}')
-                    except TelegramError as error:
-                        logger.error('Ошибка Telegram при отправке '
-                                     f'изображения {image_url}: {error}')
-
-            if post.get('video'):
-                for video_url in post['video']:
-                    try:
-                        # Проверка, было ли видео уже загружено
-                        if video_url in video_cache:
-                            video_path = video_cache[video_url]
-                        else:
-                            response = requests.get(video_url)
-                            response.raise_for_status()
-                            # Загрузка видео
-                            video_data = response.content
-                            video_path = ('/mnt/data/'
-                                          f'{os.path.basename(video_url)}')
-                            # Убедимся, что директория существует
-                            os.makedirs(os.path.dirname(video_path),
-                                        exist_ok=True)
-
-                            with open(video_path, 'wb') as video_file:
-                                video_file.write(video_data)
-                            # Сохранение пути к видео в кэш
-                            video_cache[video_url] = video_path
-                        # Отправка видео
-                        with open(video_path, 'rb') as video_file:
-                            await context.bot.send_video(chat_id=user_id,
-                                                         video=video_file)
-                        logger.info('Видео успешно отправлено пользователю '
-                                    f'{user_id}')
-
-                    except requests.exceptions.RequestException as e:
-                        logger.error('Ошибка при получении видео '
-                                     f'{video_url}: {e}')
-                        raise
-                    except TelegramError as error:
-                        logger.error('Ошибка Telegram при отправке видео '
-                                     f'{video_url}: {error}')
-                        raise
-
-        async def process_user(user):
-            """Асинхронная обработка пользователей"""
-            user_id = user['id']
-            if user.get('active'):
-                user_timezone_offset = user.get('time_zone')
-                user_timezone = convert_time_zone(user_timezone_offset)
-
-                now_local = now_utc.astimezone(user_timezone)
-                start_time = datetime.strptime(user.get('start_time')[:5],
-                                               '%H:%M').time()
-                end_time = datetime.strptime(user.get('end_time')[:5],
-                                             '%H:%M').time()
-
-                logger.info(f'Проверка времени для пользователя {user_id}: '
-                            f'now={now_local.time()}, '
-                            f'start_time={start_time}, '
-                            f'end_time={end_time}')
-
-                # Проверка временного интервала с учетом пересечения дня
-                if ((start_time <= end_time
-                    and start_time <= now_local.time() <= end_time)
-                        or (start_time > end_time
-                            and (now_local.time() >= start_time
-                                 or now_local.time() <= end_time))):
-                    for post in posts:
-                        if (isinstance(post, dict) and 'date_create' in post
-                                and 'title' in post and 'text' in post):
-                            try:
-                                post_id = post['id']
-                                post_time = datetime.strptime(
-                                    post['date_create'],
-                                    '%Y-%m-%dT%H:%M:%S.%fZ'
-                                ).replace(tzinfo=pytz.utc)
-                                logger.info('Проверка времени поста '
-                                            f'{post_id}: {post_time}')
-                                post_time_local = post_time.astimezone(
-                                    user_timezone
-                                )
-
-                                if post_time_local >= (
-                                        now_local - timedelta(hours=24)
-                                ):
-                                    await send_post(user, post)
-                                    last_sent_posts[user_id] = post_id
-
-                                # Удаление старых записей из списка отправленных постов
-                                if user_id in last_sent_posts and isinstance(last_sent_posts[user_id], list):
-                                    if len(last_sent_posts[user_id]) > 10:
-                                        last_sent_posts[user_id].pop(0)
-                                else:
-                                    last_sent_posts[user_id] = []
-
-                                # Обновление списка отправленных постов для пользователя
-                                last_sent_posts[user_id].append(post_id)
-
-                            except TelegramError as error:
-                                if 'blocked by the user' in str(error):
-                                    await handle_block_error(user['id'])
-                                else:
-                                    logger.error('Ошибка при отправке поста '
-                                                 f"пользователю {user['id']}: "
-                                                 f'{error}')
-
-                            except Exception as e:
-                                logger.error('Неизвестная ошибка при отправке '
-                                             'поста пользователю '
-                                             f"{user['id']}: {e}")
-
-        await asyncio.gather(*(process_user(user) for user in users))
 
-        # Удаление временных файлов после рассылки всем пользователям
-        for video_path in video_cache.values():
-            try:
-                os.remove(video_path)
-                logger.info(f'Временный файл {video_path} удален.')
-            except OSError as error:
-                logger.error('Ошибка при удалении временного файла '
-                             f'{video_path}: {error}')
+# Запуск тиков по открытию окон, новым постам и изменениям пользователей
+news_wakeup = TickScheduler(send_news)
+
 
+async def poll_posts(context: ContextTypes.DEFAULT_TYPE):
+    """Проверка новых постов; при их появлении тик запускается сразу"""
+    version = post_feed.version
+    await post_feed.refresh()
+    if post_feed.version != version:
+        logger.info('Появились новые посты, запуск рассылки')
+        news_wakeup.wake()
+
+
+async def sync_roster(context: ContextTypes.DEFAULT_TYPE):
+    """Синхронизация локального зеркала пользователей"""
+    try:
+        await roster.sync()
     except Exception as e:
-        logger.error(f'Ошибка при рассылке новостей: {e}')
+        logger.error('Ошибка синхронизации пользователей: %s', e)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -475,12 +416,71 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await keep_settings(update, context)
             return ConversationHandler.END
     except Exception as e:
-        logger.error(f'Ошибка при обработке нажатия кнопок: {e}')
-
-
-def main():
-    """Запуск приложения"""
-    app = Application.builder().token(API_TOKEN).request(request).build()
+        logger.error('Ошибка при обработке нажатия кнопок: %s', e)
+
+
+async def on_startup(app: Application):
+    """Подготовка общих ресурсов при запуске приложения"""
+    await api_client.start()
+    ledger.open()
+    file_id_cache.open()
+    media_cache.open()
+    broadcast_queue.open()
+    broadcast_queue_depth.set_function(broadcast_queue.pending)
+    tick_lag.set_function(news_ticks.lag)
+    if not BROADCAST_WORKERS:
+        # Задания, захваченные до перезапуска, продолжаются сразу
+        released = broadcast_queue.release()
+        if released:
+            logger.info('Продолжаются прерванные задания рассылки: %s',
+                        released)
+    send_scheduler.start()
+    # Ответы пользователям идут вне очереди и первыми в общем лимите
+    request.before_send = send_scheduler.reserve
+    if not BROADCAST_WORKERS:
+        await broadcast_bot.initialize()
+    send_queue_depth.set_function(lambda: send_scheduler.pending)
+    write_queue_depth.set_function(lambda: len(write_behind))
+    await metrics_server.start(METRICS_LISTEN, METRICS_PORT)
+    roster.subscribe(window_index.on_change)
+    # После индекса окон: время следующего тика считается по нему
+    roster.subscribe(news_wakeup.on_change)
+    write_behind.subscribe(roster.apply)
+    write_behind.start()
+    try:
+        await roster.load()
+    except ApiError as error:
+        # Зеркало догрузится при следующей синхронизации
+        logger.error('Не удалось загрузить пользователей: %s', error)
+
+
+async def on_shutdown(app: Application):
+    """Освобождение общих ресурсов при остановке приложения"""
+    await metrics_server.stop()
+    await send_scheduler.stop()
+    await broadcast_bot.shutdown()
+    await write_behind.stop()
+    await media_fetcher.close()
+    file_id_cache.close()
+    media_cache.close()
+    await api_client.close()
+    ledger.close()
+    broadcast_queue.close()
+
+
+def build_application():
+    """Приложение с обработчиками и периодическими задачами"""
+    app = (
+        Application.builder()
+        .token(API_TOKEN)
+        .base_url(TELEGRAM_BASE_URL)
+        .request(request)
+        .get_updates_request(updates_request)
+        .concurrent_updates(ChatUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Обработчик конверсии
     conv_handler = ConversationHandler(
@@ -521,8 +521,36 @@ def main():
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, say_hi))
 
-    app.job_queue.run_repeating(send_news, interval=600, first=10)
-    app.run_polling()
+    app.job_queue.run_repeating(sync_roster, interval=ROSTER_SYNC_INTERVAL,
+                                first=ROSTER_SYNC_INTERVAL)
+    app.job_queue.run_repeating(poll_posts, interval=POSTS_POLL_INTERVAL,
+                                first=POSTS_POLL_INTERVAL)
+    # Тики планируются по открытию окон и появлению постов
+    news_wakeup.start(app.job_queue, first=10)
+    if not BROADCAST_WORKERS:
+        # Остаток рассылки до перезапуска доставляется сразу после запуска
+        app.job_queue.run_once(resume_news, when=0)
+    return app
+
+
+def main():
+    """Запуск приложения"""
+    setup_logging()
+    app = build_application()
+
+    # Обработчики обновлений остаются в основном процессе,
+    # рассылку выполняют исполнители шардов
+    workers = []
+    if BROADCAST_WORKERS and BROADCAST_SPAWN_WORKERS:
+        workers = start_workers(BROADCAST_WORKERS)
+    try:
+        if UPDATE_MODE == 'webhook':
+            run_webhook(app)
+        else:
+            app.run_polling()
+    finally:
+        stop_workers(workers)
+        stop_logging()
 
 
 if __name__ == '__main__':